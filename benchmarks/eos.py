@@ -0,0 +1,42 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+
+Times load_au_params, calculate_pressure, calculate_pressure_array and PressureGrid.
+
+Usage: python benchmarks/eos.py
+'''
+
+import timeit
+
+import numpy as np
+
+from pypressxrd.logic import PressureGrid, calculate_pressure, calculate_pressure_array, load_au_params
+
+
+def best(function, number):
+    return 1e6*min(timeit.repeat(function, number=number, repeat=5))/number
+
+
+def main():
+    print('load_au_params: {:.1f} us'.format(best(lambda: load_au_params(300.), 1000)))
+    print('calculate_pressure: {:.1f} us'.format(
+        best(lambda: calculate_pressure(15.1, 300., 20., '111', 'Au'), 1000)))
+    tth = np.linspace(14., 16., 10000)
+    temperature = np.linspace(10., 490., 10000)
+    print('calculate_pressure_array, 10000 peaks at one temperature: {:.1f} us'.format(
+        best(lambda: calculate_pressure_array(tth, 300., 20.), 20)))
+    print('calculate_pressure_array, 10000 peaks and temperatures: {:.1f} us'.format(
+        best(lambda: calculate_pressure_array(tth, temperature, 20.), 20)))
+
+    grid = PressureGrid(energy=20.)
+    build = best(grid.build, 1)
+    print('PressureGrid with {} points and error bound {:.1e} GPa, built in {:.0f} ms'.format(
+        grid.table.size, grid.error_bound, build/1000))
+    print('PressureGrid, one peak: {:.1f} us'.format(best(lambda: grid.pressure(15.1, 300.), 1000)))
+    print('PressureGrid, 10000 peaks and temperatures: {:.1f} us'.format(
+        best(lambda: grid.pressure(tth, temperature), 20)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+
+Shows that fit_pseudo_voigt_global scales linearly with the number of scans.
+
+Usage: python benchmarks/fit_global.py
+'''
+
+import timeit
+
+import numpy as np
+
+from pypressxrd.logic import fit_pseudo_voigt, fit_pseudo_voigt_global, pseudo_voigt
+
+
+def make_scans(nscans, npts=201, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.linspace(10.5, 11.5, npts)
+    x0 = np.linspace(10.9, 11.1, nscans)[:, None]
+    y = pseudo_voigt(x, x0, 0.03, 100., 10., 0.3)
+    return x, y+rng.normal(0, 1., y.shape)
+
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>16}'.format('scans', 'global (ms)', 'loop (ms)', 'global/scan (ms)'))
+    for nscans in [10, 100, 1000]:
+        x, y = make_scans(nscans)
+        fit = min(timeit.repeat(lambda: fit_pseudo_voigt_global(x, y), number=1, repeat=3))
+        loop = min(timeit.repeat(lambda: [fit_pseudo_voigt(x, yi) for yi in y], number=1, repeat=3))
+        print('{:>8} {:>14.1f} {:>14.1f} {:>16.2f}'.format(nscans, 1000*fit, 1000*loop, 1000*fit/nscans))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+
+Compares fit_pseudo_voigt with the analytic Jacobian and with finite differences.
+
+Usage: python benchmarks/fit_jacobian.py
+'''
+
+import timeit
+
+import numpy as np
+
+import pypressxrd.logic as logic
+
+
+def make_scans(nscans=50, npts=201, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.linspace(10.5, 11.5, npts)
+    scans = []
+    for x0 in np.linspace(10.9, 11.1, nscans):
+        y = logic.pseudo_voigt(x, x0, 0.05, 100., 10., 0.3)
+        scans.append(y+rng.normal(0, 1., npts))
+    return x, scans
+
+
+def count_evaluations(x, scans, **kwargs):
+    "Average number of model evaluations per fit."
+    calls = [0]
+    original = logic.PseudoVoigtEvaluator.evaluate
+
+    def counted(*args, **kwargs):
+        calls[0] += 1
+        return original(*args, **kwargs)
+
+    logic.PseudoVoigtEvaluator.evaluate = counted
+    try:
+        for y in scans:
+            logic.fit_pseudo_voigt(x, y, **kwargs)
+    finally:
+        logic.PseudoVoigtEvaluator.evaluate = original
+    return calls[0]/len(scans)
+
+
+def main():
+    x, scans = make_scans()
+    print('{:>10} {:>10} {:>14} {:>14}'.format('fit_alpha', 'jac', 'evals/fit', 'time/fit (ms)'))
+    for fit_alpha in [True, False]:
+        for jac in [False, True]:
+            kwargs = dict(fit_alpha=fit_alpha, alpha_guess=0.3, jac=jac)
+            evaluations = count_evaluations(x, scans, **kwargs)
+            time = min(timeit.repeat(lambda: [logic.fit_pseudo_voigt(x, y, **kwargs) for y in scans],
+                                     number=1, repeat=5))
+            print('{:>10} {:>10} {:>14.1f} {:>14.3f}'.format(str(fit_alpha), str(jac), evaluations,
+                                                             1000*time/len(scans)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+
+Compares fitting a pressure ramp from the default guess with fit_pseudo_voigt_series.
+
+Usage: python benchmarks/fit_series.py
+'''
+
+import timeit
+
+import numpy as np
+
+import pypressxrd.logic as logic
+
+
+def make_ramp(nscans, npts=201, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.linspace(10.5, 11.5, npts)
+    x0 = np.linspace(10.8, 11.2, nscans)[:, None]
+    y = logic.pseudo_voigt(x, x0, 0.03, 100., 10., 0.3)
+    return x, y+rng.normal(0, 1., y.shape)
+
+
+def count_calls(function):
+    calls = [0]
+    original = logic.PseudoVoigtEvaluator.evaluate
+
+    def counted(*args, **kwargs):
+        calls[0] += 1
+        return original(*args, **kwargs)
+
+    logic.PseudoVoigtEvaluator.evaluate = counted
+    try:
+        function()
+    finally:
+        logic.PseudoVoigtEvaluator.evaluate = original
+    return calls[0]
+
+
+def main():
+    x, y = make_ramp(200)
+
+    def cold():
+        return [logic.fit_pseudo_voigt(x, yi) for yi in y]
+
+    def warm():
+        return logic.fit_pseudo_voigt_series(x, y)
+
+    def extrapolated():
+        return logic.fit_pseudo_voigt_series(x, y, extrapolate=True)
+
+    print('{:>14} {:>14} {:>14}'.format('start', 'time (ms)', 'evaluations'))
+    for name, function in [('default', cold), ('warm', warm), ('extrapolated', extrapolated)]:
+        time = min(timeit.repeat(function, number=1, repeat=3))
+        print('{:>14} {:>14.1f} {:>14}'.format(name, 1000*time, count_calls(function)))
+
+
+if __name__ == '__main__':
+    main()
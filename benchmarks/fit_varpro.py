@@ -0,0 +1,49 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+
+Compares fit_pseudo_voigt with fit_pseudo_voigt_varpro, from poor initial guesses.
+
+Usage: python benchmarks/fit_varpro.py
+'''
+
+import time
+import warnings
+
+import numpy as np
+
+from pypressxrd.logic import fit_pseudo_voigt, fit_pseudo_voigt_varpro, pseudo_voigt
+
+
+def run(function, scans, x, fit_alpha):
+    found = 0
+    start = time.perf_counter()
+    for x0, y, p0 in scans:
+        try:
+            popt = function(x, y, p0=p0, fit_alpha=fit_alpha, alpha_guess=0.3)
+        except RuntimeError:
+            continue
+        found += abs(popt[0]-x0) < 1e-3
+    return 1000*(time.perf_counter()-start)/len(scans), found
+
+
+def main(nscans=200, seed=0):
+    warnings.simplefilter('ignore')
+    rng = np.random.RandomState(seed)
+    print('{:>8} {:>10} {:>14} {:>10} {:>14} {:>10}'.format('points', 'alpha', 'curve_fit (ms)', 'found',
+                                                            'varpro (ms)', 'found'))
+    for npts in [101, 2001, 10001]:
+        x = np.linspace(10.5, 11.5, npts)
+        scans = []
+        for i in range(nscans):
+            x0 = rng.uniform(10.8, 11.2)
+            y = pseudo_voigt(x, x0, 0.03, 100., 10., 0.3)+rng.normal(0, 1., npts)
+            scans.append((x0, y, [x0+rng.uniform(-0.1, 0.1), 0.1, 300., 10., 0.5]))
+        for fit_alpha in [True, False]:
+            results = run(fit_pseudo_voigt, scans, x, fit_alpha)+run(fit_pseudo_voigt_varpro, scans, x, fit_alpha)
+            print('{:>8} {:>10} {:>14.2f} {:>10} {:>14.2f} {:>10}'.format(npts, 'free' if fit_alpha else 'fixed',
+                                                                          *results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+
+Compares pseudo_voigt with PseudoVoigtEvaluator, and fit_pseudo_voigt using each.
+
+Usage: python benchmarks/pseudo_voigt.py
+'''
+
+import timeit
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from pypressxrd.logic import PseudoVoigtEvaluator, fit_pseudo_voigt, pseudo_voigt, pseudo_voigt_jacobian
+
+
+def best(function, number):
+    return 1e6*min(timeit.repeat(function, number=number, repeat=5))/number
+
+
+def main():
+    params = (11.0, 0.03, 100., 10., 0.3)
+    print('{:>8} {:>18} {:>18} {:>10}'.format('points', 'pseudo_voigt (us)', 'evaluator (us)', 'speedup'))
+    for npts in [101, 1001, 10001, 100001]:
+        x = np.linspace(10.5, 11.5, npts)
+        evaluator = PseudoVoigtEvaluator(x)
+        number = max(10, 1000000//npts)
+        function = best(lambda: pseudo_voigt(x, *params), number)
+        buffered = best(lambda: evaluator.evaluate(*params), number)
+        print('{:>8} {:>18.1f} {:>18.1f} {:>10.2f}'.format(npts, function, buffered, function/buffered))
+
+    rng = np.random.RandomState(0)
+    x = np.linspace(10.5, 11.5, 10001)
+    y = pseudo_voigt(x, *params)+rng.normal(0, 1., x.size)
+    p0 = [10.98, 0.05, 80., 10., 0.5]
+    function = best(lambda: curve_fit(pseudo_voigt, x, y, p0=p0, jac=pseudo_voigt_jacobian), 20)
+    buffered = best(lambda: fit_pseudo_voigt(x, y, p0=p0), 20)
+    print('\nfit of 10001 points: pseudo_voigt {:.0f} us, evaluator {:.0f} us'.format(function, buffered))
+
+
+if __name__ == '__main__':
+    main()
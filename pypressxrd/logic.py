@@ -3,11 +3,109 @@
  See LICENSE file.
 '''
 
+import io
+import os
+import bisect
+import re
+import json
+import mmap
+import hashlib
+import warnings
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from collections import OrderedDict,namedtuple
+
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.optimize import curve_fit
+from scipy.sparse import csr_matrix
+from scipy.optimize import curve_fit,least_squares
 import matplotlib.pyplot as plt
 
+ScanMetadata = namedtuple('ScanMetadata',['temperature','energy','date','count_time','count_mode'])
+ScanMetadata.__doc__ = """Metadata read from the header of a scan, see read_metadata.
+
+temperature: dict
+    Temperatures in Kelvin by sensor name (e.g. "Control", "Sample").
+
+energy: float
+    X-ray energy in keV.
+
+date: string
+    Date in the #D line.
+
+count_time: float
+    Counting time (#T, in seconds) or monitor counts (#M).
+
+count_mode: string
+    'time' or 'monitor', depending on which of #T and #M was found.
+"""
+
+def read_pairs(text):
+    """Reads a line with 'name: valueK' pairs into a dictionary."""
+    raw = text.split()
+    return {raw[2*i].strip(':'):float(raw[2*i+1].strip('K')) for i in range(len(raw)//2)}
+
+# Each beamline has a list of (field, pattern, converter). A pattern is tried on
+# every header line, and the converter takes its match. Fields that give a
+# dictionary are merged over all matching lines, the others keep the first match.
+BEAMLINE_HEADERS = {
+    '4-ID-D': [
+        ('temperature',re.compile(r'#X(.*)'),lambda match: read_pairs(match.group(1))),
+        ('energy',re.compile(r'.*?Energy:(.*?)eV'),lambda match: float(match.group(1))),
+        ('date',re.compile(r'#D\s+(.*)'),lambda match: match.group(1).strip()),
+        ('count_time',re.compile(r'#T\s+(\S+)'),lambda match: float(match.group(1))),
+        ('count_mode',re.compile(r'#T\s'),lambda match: 'time'),
+        ('count_time',re.compile(r'#M\s+(\S+)'),lambda match: float(match.group(1))),
+        ('count_mode',re.compile(r'#M\s'),lambda match: 'monitor'),
+    ],
+}
+
+def read_metadata(header,beamline='4-ID-D'):
+    """Reads temperature, energy, date and counting time from a scan header in one pass.
+
+    Lines are read until the first data row, and each one is tested against the
+    precompiled patterns of the beamline in BEAMLINE_HEADERS.
+
+    Parameters
+    -----------
+    header: string
+        Text of the scan. Only the part before the data is read.
+
+    beamline: string (Optional)
+        Key of BEAMLINE_HEADERS with the patterns used to read the header.
+
+    Returns
+    -----------
+    metadata: pypressxrd.logic.ScanMetadata
+        Fields that are not found are None, except temperature that is an empty dictionary.
+    """
+
+    table = BEAMLINE_HEADERS[beamline]
+    found = {'temperature':{}}
+
+    start = 0
+    while start < len(header):
+        end = header.find('\n',start)
+        if end < 0:
+            end = len(header)
+        line = header[start:end]
+        start = end+1
+
+        if line[:1] != '#' and line.strip() != '':
+            break
+
+        for field,pattern,converter in table:
+            match = pattern.match(line)
+            if match is None:
+                continue
+            value = converter(match)
+            if isinstance(value,dict):
+                found.setdefault(field,{}).update(value)
+            elif field not in found:
+                found[field] = value
+
+    return ScanMetadata(*[found.get(field) for field in ScanMetadata._fields])
+
 def get_temperature(header):
     """Reads the temperature from the header of a spec file from 4-ID-D.
 
@@ -16,24 +114,13 @@ def get_temperature(header):
     header: string
         String containing the file header where the temperature is saved.
 
-    temp_source: string
-        Name of the temperature to be read. Normal stardard is "Control" or "Sample".
-
     Returns
     -----------
-    temperature: float
-        Temperature from the selected source.
+    temperature: dict
+        Temperatures by source. Normal standard is "Control" or "Sample".
     """
-    
-    temperature = {}
-    
-    for line in header.split('\n'):
-        if line[:2] == '#X':
-            raw = line.strip('#X').split()
-            for i in range(int(len(raw)/2)):
-                temperature[raw[2*i].strip(':')] = float(raw[2*i+1].strip('K'))      
-                
-    return temperature
+
+    return read_metadata(header).temperature
 
 def get_energy(header):
     """Reads the x-ray energy from the header of 4-ID-D spec file.
@@ -49,16 +136,573 @@ def get_energy(header):
         X-ray energy in keV.
     """
 
-    for line in header.split('\n'):
-        if 'Energy' in line:
-            return float(line.split('Energy:')[1].split('eV')[0])
+    return read_metadata(header).energy
+
+def parse_spec_data(buf,ncols,usecols=None,dtype=np.float64):
+    """Converts the data lines of a scan into a 2-D array.
+
+    The whole block is converted by numpy's text parser in one call, so no Python
+    object is created per value. Comment lines (e.g. #C in the middle of a scan) are
+    skipped.
+
+    Parameters
+    -----------
+    buf: bytes or string
+        Text with the data lines of a scan.
+
+    ncols: int
+        Number of data columns.
+
+    usecols: list (Optional)
+        Indexes of the columns to be converted. If None, all columns are converted.
+
+    dtype: np.dtype (Optional)
+        Type of the output array.
+
+    Returns
+    -----------
+    data: np.ndarray
+        Array with shape (rows, ncols), or (rows, len(usecols)). Rows that do not
+    have ncols numbers (e.g. an aborted scan) are skipped.
+    """
+
+    if usecols is None:
+        usecols = list(range(ncols))
+
+    # The last column is always read, so that incomplete rows raise an error.
+    columns = list(usecols)
+    if ncols-1 not in columns:
+        columns.append(ncols-1)
+
+    stream = io.BytesIO(buf) if isinstance(buf,bytes) else io.StringIO(buf)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            data = np.loadtxt(stream,dtype=dtype,comments='#',usecols=columns,ndmin=2)
+        return data[:,:len(usecols)]
+    except (ValueError,UserWarning):
+        pass
+
+    # Slow path, only if some row is broken or there is no data.
+    if isinstance(buf,bytes):
+        buf = buf.decode('utf-8','replace')
+    rows = []
+    for line in buf.splitlines():
+        row = line.split()
+        if len(row) != ncols or line[0] == '#':
+            continue
+        try:
+            rows.append([float(row[i]) for i in usecols])
+        except ValueError:
+            continue
+    return np.array(rows,dtype=dtype).reshape(len(rows),len(usecols))
+
+class SpecScan(object):
+    """Single scan (#S block) read from a spec file.
+
+    It exposes the same attributes of spec2nexus.spec.SpecDataFileScan that are
+    used in pypressxrd (raw, S, scanNum, scanCmd, L, column_first, column_last
+    and data), so the rest of the code works with either of them. The columns in
+    data are np.ndarray instead of lists.
+
+    Parameters
+    -----------
+    raw: string
+        Text of the scan, starting at the #S line.
+    """
+
+    def __init__(self,raw):
+        self.raw = raw
+        self.S = raw.split('\n',1)[0][2:].strip()
+        self.scanNum = self.S.split()[0]
+        self.scanCmd = self.S[len(self.scanNum):].strip()
+        self.L = []
+        self.column_first = ''
+        self.column_last = ''
+        self.data = {}
+
+        start = raw.find('\n#L')
+        if start < 0:
+            return
+        end = raw.find('\n',start+1)
+        if end < 0:
+            end = len(raw)
+
+        # Column names may contain single spaces, spec separates them by two.
+        self.L = re.split(r'\s{2,}',raw[start+3:end].strip())
+        self.column_first = self.L[0]
+        self.column_last = self.L[-1]
+
+        data = parse_spec_data(raw[end+1:],len(self.L))
+        for i,label in enumerate(self.L):
+            self.data[label] = data[:,i]
+
+def index_spec_file(fname,start=0,stop=None,chunk_size=4*1024*1024,progress=None):
+    """Finds where each scan starts in a spec file, without parsing it.
+
+    The file is read in chunks, so memory use does not depend on its size.
+
+    Parameters
+    -----------
+    fname: string
+        Path to the spec file.
+
+    start: int (Optional)
+        Byte offset where the search starts. It must be at the beginning of a line.
+
+    stop: int (Optional)
+        Byte offset where the search stops. If None, goes to the end of the file.
+
+    chunk_size: int (Optional)
+        Number of bytes read at a time.
+
+    progress: function (Optional)
+        Called after each chunk with the fraction of the file already read. It may
+    raise an exception to stop the indexing.
+
+    Returns
+    -----------
+    index: list
+        List of (offset, line) with the byte offset and text of each #S line.
+    """
 
-def load_scan(spec,scan_number,x_label,y_label,norm_column=None):
+    starts = []
+    with open(fname,'rb') as f:
+        if stop is None:
+            stop = os.fstat(f.fileno()).st_size
+        f.seek(start)
+
+        # Keeps the end of the previous chunk to find #S split between chunks.
+        previous = b'\n'
+        position = start
+        while position < stop:
+            chunk = f.read(min(chunk_size,stop-position))
+            if len(chunk) == 0:
+                break
+            buf = previous+chunk
+            i = buf.find(b'\n#S ')
+            while i >= 0:
+                starts.append(position-len(previous)+i+1)
+                i = buf.find(b'\n#S ',i+1)
+            previous = buf[-3:]
+            position += len(chunk)
+            if progress is not None:
+                progress(float(position-start)/(stop-start))
+
+        index = []
+        for offset in starts:
+            f.seek(offset)
+            line = f.readline(stop-offset).decode('utf-8','replace')
+            index.append((offset,line.rstrip('\r\n')))
+
+    return index
+
+class SpecIndexCache(object):
+    """On-disk cache of spec file indexes.
+
+    Each spec file gets a JSON file in the cache directory with its scan index, scan
+    commands and the header metadata (see read_metadata) of the scans already read.
+    An entry is valid if the spec file still starts with the same bytes and was not
+    modified, or only grew since it was saved (spec files are written by appending),
+    in which case only the new part needs to be indexed.
+
+    When the cache gets larger than max_bytes, the least recently used entries are
+    removed.
+
+    Parameters
+    -----------
+    path: string (Optional)
+        Cache directory. If None, uses $XDG_CACHE_HOME/pypressxrd (~/.cache/pypressxrd),
+    or %LOCALAPPDATA%\\pypressxrd on Windows.
+
+    max_bytes: int (Optional)
+        Maximum size of the cache directory in bytes.
+
+    head_bytes: int (Optional)
+        Number of bytes from the start of the spec file used to identify it.
+    """
+
+    version = 2
+
+    def __init__(self,path=None,max_bytes=50*1024*1024,head_bytes=64*1024):
+        if path is None:
+            if os.name == 'nt':
+                base = os.environ.get('LOCALAPPDATA',os.path.expanduser('~'))
+            else:
+                base = os.environ.get('XDG_CACHE_HOME',os.path.join(os.path.expanduser('~'),'.cache'))
+            path = os.path.join(base,'pypressxrd')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.head_bytes = head_bytes
+
+    def entry_name(self,fname):
+        """Returns the path of the cache entry of a spec file."""
+        key = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()
+        return os.path.join(self.path,key+'.json')
+
+    def head_hash(self,fname,size):
+        """Returns the hash of the first size bytes of a file."""
+        with open(fname,'rb') as f:
+            return hashlib.sha1(f.read(size)).hexdigest()
+
+    def load(self,fname):
+        """Returns the cached state of a spec file, or None if there is no valid entry.
+
+        Parameters
+        -----------
+        fname: string
+            Path to the spec file.
+
+        Returns
+        -----------
+        state: dict
+            Cached state, see SpecFile.get_state. If the spec file only grew since it
+        was saved, 'size' is smaller than the current file size.
+        """
+
+        entry = self.entry_name(fname)
+        try:
+            with open(entry,'r') as f:
+                state = json.load(f)
+            stat = os.stat(fname)
+            if state['version'] != self.version or state['fname'] != os.path.abspath(fname):
+                return None
+            if stat.st_size < state['size']:
+                return None
+            if stat.st_size == state['size'] and stat.st_mtime != state['mtime']:
+                return None
+            if self.head_hash(fname,state['head_size']) != state['head']:
+                return None
+            # Marks the entry as recently used.
+            os.utime(entry,None)
+        except (IOError,OSError,ValueError,KeyError):
+            return None
+        return state
+
+    def save(self,fname,state):
+        """Saves the state of a spec file (see SpecFile.get_state) and evicts old entries."""
+
+        try:
+            head_size = min(self.head_bytes,state['size'])
+            state = dict(state,version=self.version,fname=os.path.abspath(fname),
+                         head_size=head_size,head=self.head_hash(fname,head_size))
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            entry = self.entry_name(fname)
+            with open(entry+'.tmp','w') as f:
+                json.dump(state,f)
+            os.replace(entry+'.tmp',entry)
+            self.evict()
+        except (IOError,OSError):
+            pass
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.path,name))
+                entries.append((stat.st_mtime,stat.st_size,name))
+        entries.sort()
+
+        total = sum(entry[1] for entry in entries)
+        for _,size,name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.path,name))
+            total -= size
+
+class SpecFile(object):
+    """Spec file reader that indexes the scans and parses them on demand.
+
+    Opening the file only records where each #S block starts and ends (see
+    index_spec_file). A scan is parsed the first time getScan asks for it.
+
+    It keeps the byte offset up to which the file was indexed, so that update() only
+    reads the part of the file written since the last call. The last scan is always
+    read again, since it may have been partially written.
+
+    If a SpecIndexCache is given, the index and the scan metadata are restored from
+    it and saved back when the index changes. The metadata read by get_metadata is
+    saved every save_every scans and by close().
+
+    It has the getScan, getScanNumbers and getScanCommands methods of
+    spec2nexus.spec.SpecDataFile, so it can be used in its place.
+
+    Parameters
+    -----------
+    fname: string
+        Path to the spec file.
+
+    cache: pypressxrd.logic.SpecIndexCache (Optional)
+        Cache where the index is stored between sessions.
+
+    beamline: string (Optional)
+        Key of BEAMLINE_HEADERS used to read the scan metadata.
+
+    progress: function (Optional)
+        Progress callback for the first indexing, see index_spec_file.
+
+    state: dict (Optional)
+        Index saved with get_state (e.g. sent to another process). If given, the
+    cache is not used and only the part of the file after it is indexed.
+    """
+
+    save_every = 100
+
+    def __init__(self,fname,cache=None,beamline='4-ID-D',progress=None,state=None):
+        self.fname = fname
+        self.cache = cache
+        self.beamline = beamline
+        self.index = OrderedDict()
+        self.metadata = {}
+        self.offset = 0
+        self.generation = 0
+        self._mtime = 0
+        self._last_start = 0
+        self._parsed = {}
+        self._unsaved = 0
+
+        if state is None and cache is not None:
+            state = cache.load(fname)
+        if state is not None:
+            self.set_state(state)
+        self.update(progress=progress)
+
+    def get_state(self):
+        """Returns the index and metadata as a dictionary that can be saved as JSON."""
+        return {'size':self.offset,
+                'mtime':self._mtime,
+                'last_start':self._last_start,
+                'index':[[key,start,end,command] for key,(start,end,command) in self.index.items()],
+                'beamline':self.beamline,
+                'metadata':{key:list(value) for key,value in self.metadata.items()}}
+
+    def set_state(self,state):
+        """Restores the index and metadata saved with get_state."""
+        self.index = OrderedDict((key,(start,end,command)) for key,start,end,command in state['index'])
+        if state['beamline'] == self.beamline:
+            self.metadata = {key:ScanMetadata(*value) for key,value in state['metadata'].items()}
+        else:
+            self.metadata = {}
+        self.offset = state['size']
+        self._mtime = state['mtime']
+        self._last_start = state['last_start']
+        self._parsed = {}
+
+    def save_cache(self):
+        """Saves the index and metadata in the cache, if there is one."""
+        if self.cache is not None:
+            self.cache.save(self.fname,self.get_state())
+        self._unsaved = 0
+
+    def close(self):
+        """Saves the metadata read since the last save in the cache."""
+        if self._unsaved > 0:
+            self.save_cache()
+
+    def __len__(self):
+        return len(self.index)
+
+    def update(self,progress=None):
+        """Indexes the scans that were appended to the file since the last read.
+
+        Parameters
+        -----------
+        progress: function (Optional)
+            Progress callback, see index_spec_file.
+
+        Returns
+        -----------
+        scan_numbers: list
+            Numbers of the scans that are new or were read again. If the file shrank
+        (e.g. it was overwritten), it is read from the start.
+        """
+
+        stat = os.stat(self.fname)
+        size = stat.st_size
+        if size < self.offset:
+            self.index.clear()
+            self.metadata.clear()
+            self._parsed.clear()
+            self.offset = 0
+            self._last_start = 0
+            self.generation += 1
+        elif size == self.offset:
+            return []
+
+        found = index_spec_file(self.fname,self._last_start,size,progress=progress)
+        self.offset = size
+        self._mtime = stat.st_mtime
+        if len(found) == 0:
+            return []
+
+        # The first block is the last scan from the previous read.
+        if len(self.index) > 0:
+            number,_ = self.index.popitem()
+            self._parsed.pop(number,None)
+            self.metadata.pop(number,None)
+
+        updated = []
+        ends = [start for start,_ in found[1:]]+[size]
+        for (start,line),end in zip(found,ends):
+            # Repeated scan numbers are renamed as spec2nexus does.
+            scan_number = line[2:].split()[0]
+            command = line[2:].strip()[len(scan_number):].strip()
+            key = scan_number
+            i = 1
+            while key in self.index:
+                key = '{}.{:d}'.format(scan_number,i)
+                i += 1
+            self.index[key] = (start,end,command)
+            updated.append(key)
+
+        self._last_start = found[-1][0]
+        self.save_cache()
+
+        return updated
+
+    def read_raw(self,scan_number):
+        """Returns the text of a scan, read from the file."""
+        start,end,_ = self.index[str(scan_number)]
+        with open(self.fname,'rb') as f:
+            f.seek(start)
+            raw = f.read(end-start).decode('utf-8','replace')
+        return raw.replace('\r\n','\n').replace('\r','\n')
+
+    def scan_id(self,scan_number):
+        """Returns a key that identifies the current content of a scan.
+
+        It changes when the scan is read again because it grew, or when the file
+        was overwritten, so it can be used as a cache key.
+        """
+        key = str(scan_number)
+        start,end,_ = self.index[key]
+        return (os.path.abspath(self.fname),self.generation,key,start,end)
+
+    def getScan(self,scan_number):
+        """Returns the scan with the given number, or None if not found."""
+        key = str(scan_number)
+        if key not in self.index:
+            return None
+        if key not in self._parsed:
+            scan = SpecScan(self.read_raw(key))
+            scan.scanNum = key
+            self._parsed[key] = scan
+        return self._parsed[key]
+
+    def read_data(self,scan_number,columns=None,dtype=np.float64):
+        """Reads the data of a scan directly from the memory-mapped file.
+
+        Only the pages of the scan are read, and the numbers are converted in bulk
+        by parse_spec_data, so this is the fast path to get the data of many scans.
+
+        Parameters
+        -----------
+        scan_number: int or string
+            Number of the scan.
+
+        columns: list (Optional)
+            Names of the columns to be read. If None, all columns are read.
+
+        dtype: np.dtype (Optional)
+            Type of the output array.
+
+        Returns
+        -----------
+        labels: list
+            Names of the columns, in the same order as in data.
+
+        data: np.ndarray
+            Array with shape (rows, columns).
+
+        Raises
+        -----------
+        ValueError
+            If one of the columns is not in the scan.
+        """
+
+        start,end,_ = self.index[str(scan_number)]
+        with open(self.fname,'rb') as f:
+            mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                label_start = mm.find(b'\n#L',start,end)
+                if label_start < 0:
+                    return [],np.empty((0,0))
+                data_start = mm.find(b'\n',label_start+1,end)+1
+                if data_start == 0:
+                    data_start = end
+                labels = mm[label_start+3:data_start].decode('utf-8','replace')
+                labels = re.split(r'\s{2,}',labels.strip())
+                if columns is None:
+                    columns = labels
+                usecols = [labels.index(label) for label in columns]
+
+                if end == self.offset:
+                    # The last line of the last scan may be incomplete.
+                    end = max(mm.rfind(b'\n',data_start,end)+1,data_start)
+                data = parse_spec_data(mm[data_start:end],len(labels),usecols=usecols,dtype=dtype)
+            finally:
+                mm.close()
+
+        return list(columns),data
+
+    def read_header(self,scan_number):
+        """Returns the text of a scan up to its #L line, read from the file."""
+        start,end,_ = self.index[str(scan_number)]
+        with open(self.fname,'rb') as f:
+            mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                stop = mm.find(b'\n#L',start,end)
+                if stop >= 0:
+                    stop = mm.find(b'\n',stop+1,end)
+                if stop < 0:
+                    stop = end
+                raw = mm[start:stop].decode('utf-8','replace')
+            finally:
+                mm.close()
+        return raw.replace('\r\n','\n').replace('\r','\n')
+
+    def get_metadata(self,scan_number):
+        """Returns the metadata of a scan, see read_metadata.
+
+        Only the scan header is read, and the result is kept in memory, so the file
+        is read only the first time. The cache is written every save_every new scans,
+        not after each one, since it holds the whole index.
+
+        Returns
+        -----------
+        metadata: pypressxrd.logic.ScanMetadata
+            Temperatures, energy, date and counting time of the scan.
+        """
+        key = str(scan_number)
+        if key not in self.metadata:
+            self.metadata[key] = read_metadata(self.read_header(key),self.beamline)
+            self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self.save_cache()
+        return self.metadata[key]
+
+    def getScanNumbers(self):
+        """Returns the scan numbers in the order they appear in the file."""
+        return list(self.index.keys())
+
+    def getScanCommands(self,scan_list=None):
+        """Returns the scan commands as '#S <number> <command>'."""
+        if scan_list is None:
+            scan_list = self.getScanNumbers()
+        return ['#S {} {}'.format(num,self.index[str(num)][2]) for num in scan_list]
+
+def load_scan(spec,scan_number,x_label,y_label,norm_column=None,dtype=None):
     """Loads a scan, temperature and energy from the 4-ID-D spec file.
 
+    With a pypressxrd.logic.SpecFile, only the x, y and norm_column columns are
+    read from the file.
+
     Parameters
     -----------
-    spec: spec2nexus.spec.SpecDataFile
+    spec: pypressxrd.logic.SpecFile or spec2nexus.spec.SpecDataFile
         Spec file
 
     scan_number: int
@@ -73,6 +717,9 @@ def load_scan(spec,scan_number,x_label,y_label,norm_column=None):
     norm_column: string (Optional)
         Name of the column to be used as a normalization. If None, then no normalization is done.
 
+    dtype: np.dtype (Optional)
+        Type of the x and y arrays (e.g. np.float32 for batch jobs). If None, float64 is used.
+
     Returns
     -----------
     x: np.ndarray
@@ -88,16 +735,115 @@ def load_scan(spec,scan_number,x_label,y_label,norm_column=None):
         Temperature from the selected source.
     """
 
-    scan = spec.getScan(scan_number)
-    x = np.array(scan.data[x_label])
-    y = np.array(scan.data[y_label])
+    if dtype is None:
+        dtype = np.float64
+
+    columns = [x_label,y_label]
+    if norm_column:
+        columns.append(norm_column)
+
+    if isinstance(spec,SpecFile):
+        _,data = spec.read_data(scan_number,columns=columns,dtype=dtype)
+        # One copy that leaves each column contiguous.
+        data = np.ascontiguousarray(data.T)
+        metadata = spec.get_metadata(scan_number)
+    else:
+        scan = spec.getScan(scan_number)
+        data = np.array([scan.data[label] for label in columns],dtype=dtype)
+        metadata = read_metadata(scan.raw)
+
+    x = data[0]
+    y = data[1]
     if norm_column:
-        y /= np.array(scan.data[norm_column])
+        y /= data[2]
+
+    return x,y,metadata.temperature,metadata.energy
 
-    temperature = get_temperature(scan.raw)
-    energy = get_energy(scan.raw)
+CachedScan = namedtuple('CachedScan',['labels','data','metadata'])
+
+class ScanCache(object):
+    """Least recently used cache of loaded scans.
+
+    Each entry holds the column labels, the data of all columns as a 2-D array and
+    the metadata of a scan, keyed by SpecFile.scan_id. When there are more than
+    max_scans entries, or their data takes more than max_bytes, the least recently
+    used ones are dropped. It can be shared between threads.
+
+    Parameters
+    -----------
+    max_scans: int (Optional)
+        Maximum number of scans kept.
+
+    max_bytes: int (Optional)
+        Maximum memory used by the scan data, in bytes.
+    """
 
-    return x,y,temperature,energy
+    def __init__(self,max_scans=100,max_bytes=256*1024*1024):
+        self.max_scans = max_scans
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._scans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scans)
+
+    def __contains__(self,key):
+        return key in self._scans
+
+    def get(self,spec,scan_number):
+        """Returns the scan as a CachedScan, reading it from the file if needed.
+
+        Parameters
+        -----------
+        spec: pypressxrd.logic.SpecFile
+            Spec file.
+
+        scan_number: int or string
+            Number of the scan.
+
+        Returns
+        -----------
+        scan: pypressxrd.logic.CachedScan
+            Labels, data (rows, columns) and metadata of the scan.
+        """
+
+        key = spec.scan_id(scan_number)
+        with self._lock:
+            if key in self._scans:
+                self._scans.move_to_end(key)
+                return self._scans[key]
+
+        labels,data = spec.read_data(scan_number)
+        scan = CachedScan(labels,data,spec.get_metadata(scan_number))
+        self.put(key,scan)
+        return scan
+
+    def put(self,key,scan):
+        """Adds a scan to the cache and drops the least recently used ones."""
+        with self._lock:
+            if key in self._scans:
+                self.nbytes -= self._scans.pop(key).data.nbytes
+            self._scans[key] = scan
+            self.nbytes += scan.data.nbytes
+            while len(self._scans) > 1 and (len(self._scans) > self.max_scans or self.nbytes > self.max_bytes):
+                _,old = self._scans.popitem(last=False)
+                self.nbytes -= old.data.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._scans.clear()
+            self.nbytes = 0
+
+    def load_scan(self,spec,scan_number,x_label,y_label,norm_column=None):
+        """Same as pypressxrd.logic.load_scan, but using the cached scan."""
+
+        scan = self.get(spec,scan_number)
+        x = scan.data[:,scan.labels.index(x_label)].copy()
+        y = scan.data[:,scan.labels.index(y_label)].copy()
+        if norm_column:
+            y /= scan.data[:,scan.labels.index(norm_column)]
+        return x,y,scan.metadata.temperature,scan.metadata.energy
 
 def pseudo_voigt(x,x0,sigma,amplitude,constant,alpha):
     """Creates a pseudo-voigt peak.
@@ -123,7 +869,162 @@ def pseudo_voigt(x,x0,sigma,amplitude,constant,alpha):
 
     return gauss+lorentz+constant
 
-def fit_pseudo_voigt(x,y,p0=None,fit_alpha=True,alpha_guess=0.5):
+class PseudoVoigtEvaluator(object):
+    """Evaluates pseudo-voigt peaks on a fixed grid without allocating arrays.
+
+    The work arrays are created once, (x-x0)**2 is shared by the gaussian and
+    lorentzian parts, and all operations are done in place. Calling the object
+    with the same arguments as pseudo_voigt lets it replace the function in
+    curve_fit. A call returns a new array, unless out is given.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+    """
+
+    def __init__(self,x):
+
+        self._x = x
+        self.x = np.ascontiguousarray(x,dtype=np.float64)
+        self._dx2 = np.empty_like(self.x)
+        self._work = np.empty_like(self.x)
+        self._out = np.empty_like(self.x)
+
+    def evaluate(self,x0,sigma,amplitude,constant,alpha,out=None):
+        """Evaluates the pseudo-voigt peak on the grid.
+
+        Parameters
+        -----------
+        x0,sigma,amplitude,constant,alpha : float
+            Parameters of the pseudo-voigt function.
+
+        out: np.ndarray (Optional)
+            Array where the result is stored. By default an array owned by the
+        evaluator is used, which is overwritten by the next call.
+
+        Returns
+        -----------
+        pseudo-voigt: np.ndarray
+            Pseudo-voigt function
+        """
+
+        if out is None:
+            out = self._out
+        dx2 = self._dx2
+        work = self._work
+
+        np.subtract(self.x,x0,out=dx2)
+        np.multiply(dx2,dx2,out=dx2)
+
+        sigma_g = sigma/np.sqrt(2*np.log(2))
+        np.multiply(dx2,-0.5/sigma_g**2,out=out)
+        np.exp(out,out=out)
+        out *= (1-alpha)*amplitude/sigma_g/np.sqrt(2*np.pi)
+
+        np.add(dx2,sigma**2,out=work)
+        np.divide(alpha*amplitude*sigma/np.pi,work,out=work)
+        out += work
+        out += constant
+        return out
+
+    def __call__(self,x,x0,sigma,amplitude,constant,alpha,out=None):
+        """Same as pseudo_voigt, but faster if x is the grid of the evaluator.
+
+        The result is stored in out if given, otherwise in a new array.
+        """
+        if x is self._x or x is self.x:
+            if out is None:
+                out = np.empty_like(self.x)
+            return self.evaluate(x0,sigma,amplitude,constant,alpha,out=out)
+        if out is None:
+            return pseudo_voigt(x,x0,sigma,amplitude,constant,alpha)
+        out[...] = pseudo_voigt(x,x0,sigma,amplitude,constant,alpha)
+        return out
+
+def pseudo_voigt_derivatives(x,x0,sigma,amplitude,constant,alpha):
+    """Derivatives of the pseudo-voigt peak with respect to each parameter.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+
+    x0,sigma,amplitude,constant,alpha : float or np.ndarray
+        Parameters of the pseudo-voigt function. Arrays must broadcast with x.
+
+    Returns
+    -----------
+    derivatives: list
+        Arrays with the derivatives with respect to x0, sigma, amplitude, constant
+    and alpha, with the broadcast shape of x and the parameters.
+    """
+
+    sigma_g2 = sigma**2/2/np.log(2)
+    dx = x-x0
+    dx2 = dx*dx
+    inverse = 1./(dx2+sigma**2)
+
+    # Peaks with unit area.
+    gauss = np.exp(dx2*(-0.5/sigma_g2))
+    gauss *= 1./np.sqrt(2*np.pi*sigma_g2)
+    lorentz = inverse*(sigma/np.pi)
+
+    # Gaussian and lorentzian parts of the peak.
+    part_g = gauss*((1-alpha)*amplitude)
+    part_l = lorentz*(alpha*amplitude)
+
+    return [dx*(part_g/sigma_g2+part_l*2*inverse),
+            (part_g*(dx2/sigma_g2-1)+part_l*(dx2-sigma**2)*inverse)/sigma,
+            (1-alpha)*gauss+alpha*lorentz,
+            np.ones(np.shape(dx)),
+            amplitude*(lorentz-gauss)]
+
+def pseudo_voigt_jacobian(x,x0,sigma,amplitude,constant,alpha):
+    """Derivatives of the pseudo-voigt peak with respect to its parameters.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+
+    x0,sigma,amplitude,constant,alpha : float
+        Parameters of the pseudo-voigt function.
+
+    Returns
+    -----------
+    jacobian: np.ndarray
+        Array with shape (len(x), 5), where the columns are the derivatives with
+    respect to x0, sigma, amplitude, constant and alpha.
+    """
+
+    return np.stack(pseudo_voigt_derivatives(x,x0,sigma,amplitude,constant,alpha),axis=-1)
+
+def guess_pseudo_voigt(x,y,alpha_guess=0.5):
+    """Initial guess of the pseudo-voigt parameters, from the maximum of the data.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+
+    y: np.ndarray
+        Array with y values
+
+    alpha_guess: float (Optional)
+        Initial guess of alpha.
+
+    Returns
+    -----------
+    p0: list
+        Initial guess of x0, sigma, amplitude, constant and alpha.
+    """
+
+    width = (x.max()-x.min())/10.
+    index = y == y.max()
+    return [x[index][0],width,y.max()*width*np.sqrt(np.pi/np.log(2)),y[0],alpha_guess]
+
+def fit_pseudo_voigt(x,y,p0=None,fit_alpha=True,alpha_guess=0.5,jac=True):
     """Fits the data with a pseudo-voigt peak.
 
     Parameters
@@ -145,6 +1046,10 @@ def fit_pseudo_voigt(x,y,p0=None,fit_alpha=True,alpha_guess=0.5):
         If alpha is being fitted, then this will be the initial guess. Otherwise it will be the fixed parameter used.
     For lorenzian: alpha = 1, for gaussian: alpha = 0.
 
+    jac: boolean (Optional)
+        If True, the optimizer uses the analytic derivatives from pseudo_voigt_jacobian.
+    Otherwise they are estimated by finite differences.
+
     Returns
     -----------
     popt: np.ndarray
@@ -152,20 +1057,867 @@ def fit_pseudo_voigt(x,y,p0=None,fit_alpha=True,alpha_guess=0.5):
     """
 
     if p0 is None:
-        width = (x.max()-x.min())/10.
-        index = y == y.max()
-        p0 = [x[index][0],width,y.max()*width*np.sqrt(np.pi/np.log(2)),y[0],alpha_guess]
+        p0 = guess_pseudo_voigt(x,y,alpha_guess)
 
+    # curve_fit only subtracts the data from the model, so the result can be
+    # stored in the same array at every call.
+    model = PseudoVoigtEvaluator(x)
+    out = np.empty_like(model.x)
     if fit_alpha is False:
-        popt,pcov = curve_fit(lambda x,x0,sigma,amplitude,constant: pseudo_voigt(x,x0,sigma,amplitude,constant,alpha_guess),
-                              x,y,p0=p0[:-1])
+        def function(x,x0,sigma,amplitude,constant):
+            return model(x,x0,sigma,amplitude,constant,alpha_guess,out=out)
+
+        def jacobian(x,x0,sigma,amplitude,constant):
+            return pseudo_voigt_jacobian(x,x0,sigma,amplitude,constant,alpha_guess)[:,:4]
+
+        popt,pcov = curve_fit(function,x,y,p0=p0[:-1],jac=jacobian if jac else None)
         popt = np.append(popt,alpha_guess)
     else:
-        popt,pcov = curve_fit(pseudo_voigt,x,y,p0=p0)
-        
+        def function(x,x0,sigma,amplitude,constant,alpha):
+            return model(x,x0,sigma,amplitude,constant,alpha,out=out)
+
+        popt,pcov = curve_fit(function,x,y,p0=p0,jac=pseudo_voigt_jacobian if jac else None)
+
 
     return popt
 
+def find_peak_window(x,y,width=4.,smooth=5,min_points=10,center=None,search=None):
+    """Finds the strongest peak of a scan and the window around it.
+
+    The data is smoothed with a moving average, the peak is its maximum, and the
+    FWHM is where the smoothed data crosses half of the height above the
+    background (the minimum of the smoothed data).
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+
+    y: np.ndarray
+        Array with y values
+
+    width: float (Optional)
+        Half width of the window in units of FWHM.
+
+    smooth: int (Optional)
+        Number of points of the moving average.
+
+    min_points: int (Optional)
+        Minimum number of points in the window. Smaller windows are widened.
+
+    center: float (Optional)
+        Expected position of the peak, e.g. from tth_from_pressure.
+
+    search: float (Optional)
+        If center is given, the peak is the strongest one within search of center.
+
+    Returns
+    -----------
+    p0: list
+        Initial guess of the pseudo-voigt parameters of the peak, with alpha of 0.5.
+
+    window: tuple
+        Minimum and maximum x of the window.
+
+    Raises
+    -----------
+    ValueError
+        If center is given and there are no points within search of it.
+    """
+
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    smooth = max(1,min(int(smooth),y.size))
+    smoothed = np.convolve(y,np.ones(smooth)/smooth,mode='same')
+    # The edges are averaged with fewer points.
+    edge = smooth//2
+    if edge > 0:
+        smoothed[:edge] = smoothed[edge]
+        smoothed[-edge:] = smoothed[-edge-1]
+
+    peak = np.argmax(smoothed)
+    if center is not None:
+        near = np.abs(x-center) <= (np.inf if search is None else search)
+        if not np.any(near):
+            raise ValueError('There are no points within {} of {}.'.format(search,center))
+        peak = np.flatnonzero(near)[np.argmax(smoothed[near])]
+    background = smoothed.min()
+    height = smoothed[peak]-background
+    above = smoothed >= background+height/2.
+    left = peak
+    while left > 0 and above[left-1]:
+        left -= 1
+    right = peak
+    while right < y.size-1 and above[right+1]:
+        right += 1
+    step = np.abs(np.diff(x)).max() if x.size > 1 else 0.
+    fwhm = max(abs(x[right]-x[left]),step)
+
+    x0 = x[peak]
+    p0 = [x0,fwhm/2.,height*fwhm/2.*np.sqrt(np.pi/np.log(2)),background,0.5]
+    half = max(width*fwhm,np.sort(np.abs(x-x0))[min(min_points,x.size)-1])
+    return p0,(x0-half,x0+half)
+
+def fit_pseudo_voigt_window(x,y,width=4.,smooth=5,fit_alpha=True,alpha_guess=0.5,min_points=10,center=None,
+                            search=None):
+    """Fits a pseudo-voigt peak to the data in a window around the strongest peak.
+
+    Fitting only the window is faster for wide scans, and other peaks outside of
+    it do not affect the result.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+
+    y: np.ndarray
+        Array with y values
+
+    width, smooth, min_points, center, search:
+        See find_peak_window.
+
+    fit_alpha, alpha_guess:
+        See fit_pseudo_voigt.
+
+    Returns
+    -----------
+    popt: np.ndarray
+        Array with the optimized pseudo-voigt parameters.
+
+    window: tuple
+        Minimum and maximum x of the fitted data.
+    """
+
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    p0,(xmin,xmax) = find_peak_window(x,y,width=width,smooth=smooth,min_points=min_points,center=center,
+                                      search=search)
+    p0[4] = alpha_guess
+    index = (x >= xmin) & (x <= xmax)
+
+    popt = fit_pseudo_voigt(x[index],y[index],p0=p0,fit_alpha=fit_alpha,alpha_guess=alpha_guess)
+    return popt,(xmin,xmax)
+
+def fit_pseudo_voigt_varpro(x,y,p0=None,fit_alpha=True,alpha_guess=0.5):
+    """Fits the data with a pseudo-voigt peak by variable projection.
+
+    The amplitude and constant enter the pseudo-voigt linearly, and so do the
+    amplitudes of its gaussian and lorentzian parts, a1 = (1-alpha)*amplitude and
+    a2 = alpha*amplitude. For each x0 and sigma these are found by linear least
+    squares, so the nonlinear search only covers x0 and sigma. The Jacobian of the
+    projected residuals is the exact one of Golub and Pereyra.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values
+
+    y: np.ndarray
+        Array with y values
+
+    p0: list (Optional)
+        Initial guess, only x0 and sigma are used.
+
+    fit_alpha: boolean (Optional)
+        If False, alpha is fixed to alpha_guess.
+
+    alpha_guess: float (Optional)
+        Value of alpha if it is not fitted.
+
+    Returns
+    -----------
+    popt: np.ndarray
+        Array with the optimized pseudo-voigt parameters, as in fit_pseudo_voigt.
+    """
+
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    if p0 is None:
+        p0 = guess_pseudo_voigt(x,y,alpha_guess)
+
+    # The basis has the gaussian and lorentzian with unit area, or their mixture, and
+    # the constant.
+    weights = np.eye(2) if fit_alpha else np.array([[1-alpha_guess,alpha_guess]])
+    basis = np.ones((len(weights)+1,x.size))
+    last = {}
+
+    def project(theta):
+        if last.get('theta') != tuple(theta):
+            x0,sigma = theta
+            sigma_g2 = sigma**2/2/np.log(2)
+            dx = x-x0
+            dx2 = dx*dx
+            inverse = 1./(dx2+sigma**2)
+            gauss = np.exp(dx2*(-0.5/sigma_g2))/np.sqrt(2*np.pi*sigma_g2)
+            lorentz = inverse*(sigma/np.pi)
+            basis[:-1] = weights.dot([gauss,lorentz])
+            gram = basis.dot(basis.T)
+            coeffs = np.linalg.solve(gram,basis.dot(y))
+            last.update(theta=tuple(theta),gram=gram,coeffs=coeffs,residuals=coeffs.dot(basis)-y,
+                        peaks=(dx,dx2,inverse,sigma_g2,gauss,lorentz))
+        return last
+
+    def residuals(theta):
+        return project(theta)['residuals']
+
+    def jacobian(theta):
+        values = project(theta)
+        dx,dx2,inverse,sigma_g2,gauss,lorentz = values['peaks']
+        sigma = theta[1]
+        derivatives = [[gauss*dx/sigma_g2,lorentz*2*dx*inverse],
+                       [gauss*(dx2/sigma_g2-1)/sigma,lorentz*(dx2-sigma**2)*inverse/sigma]]
+        # Gaussian and lorentzian amplitudes.
+        amplitudes = values['coeffs'][:-1].dot(weights)
+        jac = np.empty((x.size,2))
+        dot = np.zeros((len(basis),2))
+        for i,(d_gauss,d_lorentz) in enumerate(derivatives):
+            jac[:,i] = amplitudes[0]*d_gauss+amplitudes[1]*d_lorentz
+            dot[:-1,i] = weights.dot([d_gauss.dot(values['residuals']),d_lorentz.dot(values['residuals'])])
+        # Projection of the derivatives and the second term of Golub and Pereyra.
+        return jac-basis.T.dot(np.linalg.solve(values['gram'],basis.dot(jac)+dot))
+
+    result = least_squares(residuals,np.array(p0[:2],dtype=np.float64),jac=jacobian,method='lm')
+    if not result.success:
+        raise RuntimeError('Optimal parameters not found: '+result.message)
+
+    # The lorentzian changes sign with sigma, so the coefficients are found again.
+    x0,sigma = result.x[0],abs(result.x[1])
+    coeffs = project([x0,sigma])['coeffs']
+    if fit_alpha:
+        amplitude = coeffs[0]+coeffs[1]
+        alpha = coeffs[1]/amplitude
+    else:
+        amplitude = coeffs[0]
+        alpha = alpha_guess
+
+    return np.array([x0,sigma,amplitude,coeffs[-1],alpha])
+
+def fit_pseudo_voigt_series(x,y,p0=None,fit_alpha=True,alpha_guess=0.5,extrapolate=False):
+    """Fits a series of scans in order, starting each fit from the previous result.
+
+    In a pressure ramp consecutive scans have similar peaks, so the converged
+    parameters of a scan are a good initial guess for the next one. If a fit
+    fails or gives a peak outside the scan, it is repeated with the guess from
+    fit_pseudo_voigt.
+
+    Parameters
+    -----------
+    x: list
+        List with the x arrays of the scans, or a single array shared by all scans.
+
+    y: list
+        List with the y arrays of the scans.
+
+    p0: list (Optional)
+        Initial guess for the first scan, see fit_pseudo_voigt.
+
+    fit_alpha, alpha_guess:
+        See fit_pseudo_voigt.
+
+    extrapolate: boolean (Optional)
+        If True, the initial x0 is linearly extrapolated from the two previous scans.
+
+    Returns
+    -----------
+    popt: np.ndarray
+        Array with shape (N, 5) with the optimized parameters. Scans that could not
+    be fitted are NaN.
+
+    warm: np.ndarray
+        Boolean array with shape (N,), True for the scans fitted from the previous result.
+    """
+
+    nscans = len(y)
+    if isinstance(x,np.ndarray) and x.ndim == 1:
+        x = [x]*nscans
+
+    popt = np.full((nscans,5),np.nan)
+    warm = np.zeros(nscans,dtype=bool)
+    previous = []
+    for i in range(nscans):
+        guess = p0
+        if len(previous) > 0:
+            guess = popt[previous[-1]].copy()
+            if extrapolate and len(previous) > 1:
+                guess[0] = 2*popt[previous[-1],0]-popt[previous[-2],0]
+            if fit_alpha is False:
+                guess[4] = alpha_guess
+
+        attempts = [None] if guess is None else [guess,None]
+        for attempt in attempts:
+            try:
+                result = fit_pseudo_voigt(x[i],y[i],p0=attempt,fit_alpha=fit_alpha,alpha_guess=alpha_guess)
+            except (RuntimeError,ValueError):
+                continue
+            # Diverged fits are repeated from scratch.
+            if np.all(np.isfinite(result)) and x[i].min() <= result[0] <= x[i].max():
+                popt[i] = result
+                warm[i] = attempt is not None and len(previous) > 0
+                previous.append(i)
+                break
+
+    return popt,warm
+
+def fit_pseudo_voigt_global(x,y,p0=None,fit_alpha=True,alpha_guess=0.5):
+    """Fits a series of scans together, with the same sigma and alpha for all peaks.
+
+    The position, amplitude and constant of each scan are fitted separately. The
+    Jacobian is a sparse matrix, where each point only depends on the shared and
+    its own scan parameters, so the cost grows linearly with the number of scans.
+
+    Parameters
+    -----------
+    x: list
+        List with the x arrays of the scans, or a single array shared by all scans.
+
+    y: list
+        List with the y arrays of the scans, or an array with shape (N, M).
+
+    p0: np.ndarray (Optional)
+        Initial guess with shape (N, 5). By default it is estimated with
+    find_peak_window, using the median width.
+
+    fit_alpha: boolean (Optional)
+        If False, alpha is fixed to alpha_guess.
+
+    alpha_guess: float (Optional)
+        Initial guess of alpha.
+
+    Returns
+    -----------
+    popt: np.ndarray
+        Array with shape (N, 5) with the optimized parameters of each scan.
+    """
+
+    nscans = len(y)
+    if isinstance(x,np.ndarray) and x.ndim == 1:
+        x = [x]*nscans
+    sizes = np.array([len(yi) for yi in y])
+    owner = np.repeat(np.arange(nscans),sizes)
+    xs = np.concatenate([np.asarray(xi,dtype=np.float64) for xi in x])
+    ys = np.concatenate([np.asarray(yi,dtype=np.float64) for yi in y])
+
+    if p0 is None:
+        p0 = np.array([find_peak_window(xi,yi)[0] for xi,yi in zip(x,y)])
+        p0[:,1] = np.median(p0[:,1])
+        p0[:,4] = alpha_guess
+    p0 = np.asarray(p0,dtype=np.float64)
+
+    # Parameters: sigma, alpha (if fitted), and x0, amplitude and constant of each scan.
+    nshared = 2 if fit_alpha else 1
+    theta = np.concatenate([p0[0,1:2],[p0[0,4]] if fit_alpha else [],p0[:,0],p0[:,2],p0[:,3]])
+    columns = [np.zeros(xs.size,dtype=int)]
+    if fit_alpha:
+        columns.append(np.ones(xs.size,dtype=int))
+    columns += [nshared+owner,nshared+nscans+owner,nshared+2*nscans+owner]
+    indices = np.column_stack(columns).ravel()
+    indptr = np.arange(0,xs.size*len(columns)+1,len(columns))
+
+    def unpack(theta):
+        alpha = theta[1] if fit_alpha else alpha_guess
+        x0,amplitude,constant = theta[nshared:].reshape(3,nscans)
+        return x0[owner],theta[0],amplitude[owner],constant[owner],alpha
+
+    def residuals(theta):
+        return pseudo_voigt(xs,*unpack(theta))-ys
+
+    def jacobian(theta):
+        d_x0,d_sigma,d_amplitude,d_constant,d_alpha = pseudo_voigt_derivatives(xs,*unpack(theta))
+        data = [d_sigma,d_alpha] if fit_alpha else [d_sigma]
+        data = np.column_stack(data+[d_x0,d_amplitude,d_constant]).ravel()
+        return csr_matrix((data,indices,indptr),shape=(xs.size,theta.size))
+
+    result = least_squares(residuals,theta,jac=jacobian,method='trf',tr_solver='lsmr',x_scale='jac')
+    if not result.success:
+        raise RuntimeError('Optimal parameters not found: '+result.message)
+
+    alpha = result.x[1] if fit_alpha else alpha_guess
+    x0,amplitude,constant = result.x[nshared:].reshape(3,nscans)
+    return np.column_stack([x0,np.full(nscans,abs(result.x[0])),amplitude,constant,np.full(nscans,alpha)])
+
+def pad_scans(arrays,fill=0.):
+    """Stacks 1-D arrays of different lengths into a 2-D array.
+
+    Parameters
+    -----------
+    arrays: list
+        List of 1-D arrays.
+
+    fill: float (Optional)
+        Value of the padding.
+
+    Returns
+    -----------
+    stacked: np.ndarray
+        Array with shape (len(arrays), longest array).
+
+    mask: np.ndarray
+        Boolean array, True where stacked has data.
+    """
+
+    lengths = np.array([len(array) for array in arrays])
+    mask = np.arange(lengths.max())[None,:] < lengths[:,None]
+    stacked = np.full(mask.shape,fill,dtype=np.float64)
+    stacked[mask] = np.concatenate(arrays)
+    return stacked,mask
+
+def fit_pseudo_voigt_batch(x,y,mask=None,p0=None,fit_alpha=True,alpha_guess=0.5,max_iter=200,
+                           ftol=1e-10,xtol=1e-10):
+    """Fits many scans with pseudo-voigt peaks at once.
+
+    All scans are fitted together by a Levenberg-Marquardt iteration written with
+    NumPy array operations: each step evaluates the residuals and the Jacobian of
+    every scan as one array and solves all the (5x5) normal equations in one call.
+    The damping is adjusted per scan, so each scan converges as in fit_pseudo_voigt.
+
+    Parameters
+    -----------
+    x: np.ndarray or list
+        Array with shape (N, M) with the x values of N scans, or (M,) if the scans
+    share the same x. It can also be a list of 1-D arrays with different lengths.
+
+    y: np.ndarray or list
+        Array with shape (N, M) with the y values, or a list of 1-D arrays.
+
+    mask: np.ndarray (Optional)
+        Boolean array with shape (N, M), True for the points to be fitted. It is
+    created if x and y are lists.
+
+    p0: np.ndarray (Optional)
+        Initial guesses with shape (N, 5), see fit_pseudo_voigt. If None, the code
+    will create a guess for each scan.
+
+    fit_alpha: boolean (Optional)
+        Option to fit the alpha parameter.
+
+    alpha_guess: float (Optional)
+        Initial guess of alpha, or its fixed value if fit_alpha is False.
+
+    max_iter: int (Optional)
+        Maximum number of iterations.
+
+    ftol, xtol: float (Optional)
+        Relative tolerances in the sum of squares and in the parameters.
+
+    Returns
+    -----------
+    popt: np.ndarray
+        Array with shape (N, 5) with the optimized pseudo-voigt parameters.
+
+    converged: np.ndarray
+        Boolean array with shape (N,), False for the scans that did not converge.
+    """
+
+    if isinstance(y,(list,tuple)):
+        y,mask = pad_scans(y)
+        if isinstance(x,(list,tuple)):
+            x,_ = pad_scans(x)
+    y = np.asarray(y,dtype=np.float64)
+    x = np.broadcast_to(np.asarray(x,dtype=np.float64),y.shape)
+    if mask is None:
+        mask = np.ones(y.shape,dtype=bool)
+    weight = mask.astype(np.float64)
+    nscans = y.shape[0]
+
+    if p0 is None:
+        xmin = np.where(mask,x,np.inf).min(axis=1)
+        xmax = np.where(mask,x,-np.inf).max(axis=1)
+        ymasked = np.where(mask,y,-np.inf)
+        ymax = ymasked.max(axis=1)
+        width = (xmax-xmin)/10.
+        p0 = np.empty((nscans,5))
+        p0[:,0] = x[np.arange(nscans),ymasked.argmax(axis=1)]
+        p0[:,1] = width
+        p0[:,2] = ymax*width*np.sqrt(np.pi/np.log(2))
+        p0[:,3] = y[np.arange(nscans),mask.argmax(axis=1)]
+        p0[:,4] = alpha_guess
+    params = np.array(p0,dtype=np.float64)
+    if fit_alpha is False:
+        params[:,4] = alpha_guess
+    nfree = 5 if fit_alpha else 4
+
+    def residuals(params,index):
+        model = pseudo_voigt(x[index],*[params[:,i,None] for i in range(5)])
+        return (model-y[index])*weight[index]
+
+    everything = np.arange(nscans)
+    residual = residuals(params,everything)
+    cost = (residual**2).sum(axis=1)
+    damping = np.full(nscans,1e-3)
+    converged = np.zeros(nscans,dtype=bool)
+    # Scans still being fitted, only these are computed in each iteration.
+    active = everything
+
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        current = params[active]
+
+        # Jacobian with shape (N, parameters, M), so that J J^T is a batched matmul.
+        derivatives = pseudo_voigt_derivatives(x[active],*[current[:,i,None] for i in range(5)])[:nfree]
+        jacobian = np.stack(derivatives,axis=1)
+        jacobian *= weight[active,None,:]
+        jtj = np.matmul(jacobian,jacobian.transpose(0,2,1))
+        gradient = np.matmul(jacobian,residual[active,:,None])[...,0]
+
+        # Marquardt scaling of the damping by the diagonal of J^T J.
+        diagonal = np.maximum(np.einsum('nii->ni',jtj),1e-12)
+        system = jtj+(damping[active,None]*diagonal)[:,:,None]*np.eye(nfree)
+        try:
+            step = -np.linalg.solve(system,gradient[...,None])[...,0]
+        except np.linalg.LinAlgError:
+            step = -np.matmul(np.linalg.pinv(system),gradient[...,None])[...,0]
+
+        trial = current.copy()
+        trial[:,:nfree] += step
+        trial_residual = residuals(trial,active)
+        trial_cost = (trial_residual**2).sum(axis=1)
+
+        accept = np.isfinite(trial_cost) & (trial_cost <= cost[active])
+        small_step = np.sqrt((step**2).sum(axis=1)) <= xtol*(np.sqrt((current[:,:nfree]**2).sum(axis=1))+xtol)
+        small_change = (cost[active]-trial_cost) <= ftol*cost[active]
+
+        accepted = active[accept]
+        params[accepted] = trial[accept]
+        residual[accepted] = trial_residual[accept]
+        cost[accepted] = trial_cost[accept]
+        damping[active] = np.where(accept,damping[active]/10.,damping[active]*10.)
+
+        done = (accept & (small_change | small_step)) | (~accept & small_step)
+        converged[active[done]] = True
+        # Scans whose damping blew up cannot be improved anymore.
+        active = active[~done & (damping[active] < 1e16)]
+
+    params[:,1] = np.abs(params[:,1])
+
+    return params,converged
+
+HOLZAPFEL_PARAMS = {
+    'Au':dict(temperature=[0,10,50,100,150,200,250,300,350,400,450,500],
+              v0=[16.7905,16.7906,16.7984,16.8238,16.8550,16.8885,16.9232,16.959,16.9956,17.0329,17.071,17.1098],
+              k0=[180.93,180.93,179.94,177.51,174.86,172.16,169.43,166.7,163.96,161.21,158.46,155.7],
+              kp0=[6.08,6.08,6.09,6.11,6.13,6.15,6.17,6.20,6.23,6.25,6.28,6.31]),
+    'Ag':dict(temperature=[0,10,50,100,150,200,250,300,350,400,450,500],
+              v0=[16.8439,16.8439,16.8512,16.8815,16.9210,16.9644,17.0099,17.057,17.1055,17.1553,17.2063,17.2585],
+              k0=[110.85,110.85,110.31,108.68,106.83,104.91,102.96,101.0,99.03,97.05,95.07,93.07],
+              kp0=[6,6,6.01,6.03,6.05,6.08,6.12,6.15,6.19,6.22,6.26,6.3]),
+    }
+"""Volume (AA^3/atom), K (GPa) and K' of the calibrants as a function of temperature
+(K), from Holzapfel et al., J. Phys. Chem. Ref. Data 30, 515 (2001)."""
+
+def eos_ap2(compression,k0,kp0,c0,c2):
+    """AP2 equation of state of Holzapfel, with c0 and c2 from CalibrantEOS.constants."""
+    x = compression**0.3333
+    return 3*k0*(1-x)/x**5*np.exp(c0*(1-x))*(1+c2*x*(1-x))
+
+def eos_vinet(compression,k0,kp0,c0,c2):
+    """Vinet equation of state."""
+    x = compression**(1./3.)
+    return 3*k0*(1-x)/x**2*np.exp(1.5*(kp0-1)*(1-x))
+
+def eos_bm3(compression,k0,kp0,c0,c2):
+    """Third order Birch-Murnaghan equation of state."""
+    x2 = compression**(-2./3.)
+    return 1.5*k0*(x2**3.5-x2**2.5)*(1+0.75*(kp0-4)*(x2-1))
+
+def eos_ap2_derivative(compression,k0,kp0,c0,c2):
+    """Derivative of eos_ap2 with respect to V/V0."""
+    x = compression**0.3333
+    exponential = np.exp(c0*(1-x))
+    polynomial = 1+c2*x*(1-x)
+    d_x = 3*k0*exponential*((-1/x**5-5*(1-x)/x**6-c0*(1-x)/x**5)*polynomial+(1-x)/x**5*c2*(1-2*x))
+    return d_x*0.3333*compression**(0.3333-1)
+
+def eos_vinet_derivative(compression,k0,kp0,c0,c2):
+    """Derivative of eos_vinet with respect to V/V0."""
+    x = compression**(1./3.)
+    eta = 1.5*(kp0-1)
+    d_x = 3*k0*np.exp(eta*(1-x))*(-1/x**2-2*(1-x)/x**3-eta*(1-x)/x**2)
+    return d_x/3./x**2
+
+def eos_bm3_derivative(compression,k0,kp0,c0,c2):
+    """Derivative of eos_bm3 with respect to V/V0."""
+    x2 = compression**(-2./3.)
+    b = 0.75*(kp0-4)
+    d_x2 = 1.5*k0*((3.5*x2**2.5-2.5*x2**1.5)*(1+b*(x2-1))+(x2**3.5-x2**2.5)*b)
+    return d_x2*(-2./3.)*x2/compression
+
+EOS_FORMS = {'AP2':eos_ap2,'Vinet':eos_vinet,'BM3':eos_bm3}
+"""Equations of state, as functions of V/V0, K0, K0', and the AP2 constants c0 and c2."""
+
+EOS_DERIVATIVES = {'AP2':eos_ap2_derivative,'Vinet':eos_vinet_derivative,'BM3':eos_bm3_derivative}
+"""Derivatives of EOS_FORMS with respect to V/V0."""
+
+LATTICES = {'fcc':4,'bcc':2,'sc':1}
+"""Number of formula units in the cubic cell of each lattice type. The rock salt
+structure (e.g. NaCl, MgO) is fcc, with the volume of the tables per formula unit."""
+
+def miller_indices(bragg_peak):
+    """Converts a reflection like '111' into its Miller indices (1, 1, 1)."""
+    if len(bragg_peak) != 3 or not bragg_peak.isdigit():
+        raise ValueError('Could not recognize the {} bragg peak.'.format(bragg_peak))
+    return tuple(int(index) for index in bragg_peak)
+
+def reflection_allowed(lattice,bragg_peak):
+    """Checks if a reflection is allowed in a cubic lattice ('fcc', 'bcc' or 'sc')."""
+    try:
+        indices = miller_indices(bragg_peak)
+    except ValueError:
+        return False
+    if sum(indices) == 0:
+        return False
+    if lattice == 'fcc':
+        return len(set(index%2 for index in indices)) == 1
+    if lattice == 'bcc':
+        return sum(indices)%2 == 0
+    return True
+
+Calibrant = namedtuple('Calibrant',['name','lattice','z','form','temperature','v0','k0','kp0','reference'])
+Calibrant.__doc__ = """Calibrant of the pressure, see register_calibrant."""
+
+CALIBRANTS = OrderedDict()
+"""Registered calibrants by name."""
+
+_EOS = {}
+
+def register_calibrant(name,lattice,temperature,v0,k0,kp0,form='AP2',z=None,reference=''):
+    """Adds a calibrant to CALIBRANTS, replacing the one with the same name.
+
+    Parameters
+    -----------
+    name: string
+        Name of the calibrant (e.g. 'Pt'), used by calculate_pressure.
+
+    lattice: string
+        Lattice type, a key of LATTICES.
+
+    temperature: list
+        Temperatures of the tables in Kelvin, in increasing order. Pressures are
+    only calculated within this range.
+
+    v0, k0, kp0: list
+        Volume per formula unit (AA^3), K (GPa) and K' at each temperature.
+
+    form: string (Optional)
+        Equation of state, a key of EOS_FORMS.
+
+    z: int (Optional)
+        Atomic number, required by the AP2 equation of state.
+
+    reference: string (Optional)
+        Source of the parameters.
+    """
+
+    if lattice not in LATTICES:
+        raise ValueError('Unknown lattice {}, it must be one of {}.'.format(lattice,', '.join(LATTICES)))
+    if form not in EOS_FORMS:
+        raise ValueError('Unknown equation of state {}, it must be one of {}.'.format(form,', '.join(EOS_FORMS)))
+    if form == 'AP2' and z is None:
+        raise ValueError('The AP2 equation of state needs the atomic number.')
+    temperature = np.asarray(temperature,dtype=np.float64)
+    if temperature.size < 2 or np.any(np.diff(temperature) <= 0):
+        raise ValueError('The temperatures must have at least two increasing values.')
+    for values in [v0,k0,kp0]:
+        if len(values) != temperature.size:
+            raise ValueError('The tables must have one value per temperature.')
+
+    CALIBRANTS[name] = Calibrant(name,lattice,z,form,temperature,np.asarray(v0,dtype=np.float64),
+                                 np.asarray(k0,dtype=np.float64),np.asarray(kp0,dtype=np.float64),reference)
+    _EOS.pop(name,None)
+
+def unregister_calibrant(name):
+    """Removes a calibrant added with register_calibrant, and its equation of state."""
+    del CALIBRANTS[name]
+    _EOS.pop(name,None)
+
+for _name,_z in [('Au',79),('Ag',47)]:
+    register_calibrant(_name,'fcc',z=_z,form='AP2',
+                       reference='Holzapfel et al., J. Phys. Chem. Ref. Data 30, 515 (2001)',
+                       **HOLZAPFEL_PARAMS[_name])
+
+class CalibrantEOS(object):
+    """Equation of state of a calibrant with temperature dependent parameters.
+
+    The table of volume, K and K' is stored as a single array, and the three
+    parameters are interpolated together. The constants of the last used
+    temperatures are kept, so repeated calls at the same temperature only
+    evaluate the equation of state. All equations of EOS_FORMS work on arrays.
+
+    Parameters
+    -----------
+    calibrant: Calibrant
+        Calibrant, see register_calibrant.
+
+    max_cached: int (Optional)
+        Maximum number of temperatures whose constants are kept.
+    """
+
+    afg = 2337 #GPa.AA^5
+
+    def __init__(self,calibrant,max_cached=1024):
+
+        self.calibrant = calibrant
+        self.z = calibrant.z
+        self.form = calibrant.form
+        self.units = LATTICES[calibrant.lattice]
+        self.temperature = calibrant.temperature
+        self.table = np.array([calibrant.v0,calibrant.k0,calibrant.kp0])
+        self.max_cached = max_cached
+        self._equation = EOS_FORMS[calibrant.form]
+        self._constants = {}
+
+    def parameters(self,temperature):
+        """Interpolates v0, k0 and kp0.
+
+        Parameters
+        -----------
+        temperature: float or np.ndarray
+            Temperature in Kelvin.
+
+        Returns
+        -----------
+        params: np.ndarray
+            Array with shape (3,)+np.shape(temperature) with v0, k0 and kp0. Values
+        outside of the table are NaN.
+        """
+
+        if np.ndim(temperature) == 0:
+            return np.array(self._scalar(temperature)[:3])
+
+        temperature = np.asarray(temperature,dtype=np.float64)
+        index = np.clip(np.searchsorted(self.temperature,temperature),1,self.temperature.size-1)
+        low = self.temperature[index-1]
+        weight = (temperature-low)/(self.temperature[index]-low)
+        params = self.table[:,index-1]*(1-weight)+self.table[:,index]*weight
+        outside = ~((temperature >= self.temperature[0]) & (temperature <= self.temperature[-1]))
+        if np.any(outside):
+            params = np.where(outside,np.nan,params)
+        return params
+
+    def constants(self,temperature):
+        """Returns v0, k0, kp0, and c0 and c2 of the AP2 equation at a temperature.
+
+        Parameters
+        -----------
+        temperature: float or np.ndarray
+            Temperature in Kelvin. Only the results of scalars are kept.
+
+        Returns
+        -----------
+        v0, k0, kp0, c0, c2: float or np.ndarray
+            Constants of the equation of state, NaN outside of the table. c0 and c2
+        are 0 if the form is not AP2.
+        """
+
+        if np.ndim(temperature) == 0:
+            return self._scalar(temperature)
+        v0,k0,kp0 = self.parameters(temperature)
+        return (v0,k0,kp0)+self._ap2(v0,k0,kp0)
+
+    def _ap2(self,v0,k0,kp0):
+        if self.form != 'AP2':
+            return np.zeros_like(v0),np.zeros_like(v0)
+        with np.errstate(invalid='ignore'):
+            pfg0 = self.afg*(self.z/v0)**1.6666
+            c0 = -1*np.log(3*k0/pfg0)
+        c2 = (3/2)*(kp0-3)-c0
+        return c0,c2
+
+    def _scalar(self,temperature):
+        # v0, k0, kp0, c0 and c2 at a single temperature, as floats.
+        key = float(temperature)
+        values = self._constants.get(key)
+        if values is None:
+            temps = self.temperature
+            if temps[0] <= key <= temps[-1]:
+                index = min(max(int(np.searchsorted(temps,key)),1),temps.size-1)
+                weight = (key-temps[index-1])/(temps[index]-temps[index-1])
+                v0,k0,kp0 = (self.table[:,index-1]*(1-weight)+self.table[:,index]*weight).tolist()
+            else:
+                v0 = k0 = kp0 = np.nan
+            values = (v0,k0,kp0)+tuple(float(value) for value in self._ap2(v0,k0,kp0))
+            if len(self._constants) >= self.max_cached:
+                self._constants.clear()
+            self._constants[key] = values
+        return values
+
+    def pressure(self,volume,temperature):
+        """Calculates the pressure in GPa from the volume per formula unit in AA^3."""
+
+        v0,k0,kp0,c0,c2 = self.constants(temperature)
+        return self._equation(volume/v0,k0,kp0,c0,c2)
+
+    def lattice_pressure(self,lattice,temperature):
+        """Calculates the pressure in GPa from the lattice parameter in AA."""
+
+        return self.pressure(lattice**3/self.units,temperature)
+
+    def lattice_parameter(self,temperature):
+        """Lattice parameter in AA at ambient pressure."""
+
+        return (self.units*self.parameters(temperature)[0])**(1./3.)
+
+    def volume(self,pressure,temperature,tolerance=1e-12,max_iter=50):
+        """Inverts the equation of state with Newton iterations.
+
+        The initial volume is given by the Murnaghan equation of state.
+
+        Parameters
+        -----------
+        pressure: float or np.ndarray
+            Pressure in GPa.
+
+        temperature: float or np.ndarray
+            Temperature in Kelvin.
+
+        tolerance: float (Optional)
+            Relative change of the volume at which the iterations stop.
+
+        max_iter: int (Optional)
+            Maximum number of iterations.
+
+        Returns
+        -----------
+        volume: np.ndarray
+            Volume per formula unit in AA^3. NaN outside of the tables or if the
+        iterations did not converge.
+        """
+
+        v0,k0,kp0,c0,c2 = self.constants(temperature)
+        pressure = np.asarray(pressure,dtype=np.float64)
+        derivative = EOS_DERIVATIVES[self.form]
+        with np.errstate(invalid='ignore',divide='ignore',over='ignore'):
+            compression = np.broadcast_to((1+kp0*pressure/k0)**(-1/kp0),np.broadcast(pressure,v0).shape).copy()
+            for _ in range(max_iter):
+                step = (self._equation(compression,k0,kp0,c0,c2)-pressure)/derivative(compression,k0,kp0,c0,c2)
+                # The volume changes at most by a factor of 2 per iteration.
+                step = np.clip(step,-compression,compression/2.)
+                compression -= step
+                if not np.any(np.abs(step) > tolerance*compression):
+                    break
+            compression[~(np.abs(step) <= tolerance*compression)] = np.nan
+        return compression*v0
+
+def get_eos(calibrant):
+    """Returns the CalibrantEOS of a calibrant, which is built on the first call.
+
+    Parameters
+    -----------
+    calibrant: string
+        Key of CALIBRANTS.
+
+    Returns
+    -----------
+    eos: CalibrantEOS
+        Equation of state of the calibrant.
+    """
+
+    eos = _EOS.get(calibrant)
+    if eos is None:
+        eos = CalibrantEOS(CALIBRANTS[calibrant])
+        _EOS[calibrant] = eos
+    return eos
+
 def load_ag_params(temperature):
     """Load the Ag parameters for calculating the pressure. These parameters were
     extracted from Holzapfel et al., J. Phys. Chem. Ref. Data 30, 515 (2001).
@@ -181,19 +1933,13 @@ def load_ag_params(temperature):
         Volume, K and K' calibrated parameters.
     """
 
-    v0 = [16.8439,16.8439,16.8512,16.8815,16.9210,16.9644,17.0099,17.057,17.1055,17.1553,17.2063,17.2585]
-    k0 = [110.85,110.85,110.31,108.68,106.83,104.91,102.96,101.0,99.03,97.05,95.07,93.07]
-    kp0 = [6,6,6.01,6.03,6.05,6.08,6.12,6.15,6.19,6.22,6.26,6.3]
-    temp0 = [0,10,50,100,150,200,250,300,350,400,450,500]
-
-    try:
-        v0_out = float(interp1d(temp0,v0,kind='linear')(temperature))
-        k0_out = float(interp1d(temp0,k0,kind='linear')(temperature))
-        kp0_out = float(interp1d(temp0,kp0,kind='linear')(temperature))
-        return v0_out,k0_out,kp0_out
-    except ValueError:
-        print('ERROR! Temperature must be between 5-500K, but {:0.1f} was entered!'.format(temperature))
+    eos = get_eos('Ag')
+    v0_out,k0_out,kp0_out = eos.parameters(temperature)
+    if np.isnan(v0_out):
+        print('ERROR! Temperature must be between {:0.0f}-{:0.0f}K, but {:0.1f} was entered!'.format(
+            eos.temperature[0],eos.temperature[-1],temperature))
         return 0
+    return float(v0_out),float(k0_out),float(kp0_out)
 
 def load_au_params(temperature):
     """Load the Au parameters for calculating the pressure. These parameters were
@@ -210,22 +1956,16 @@ def load_au_params(temperature):
         Volume, K and K' calibrated parameters.
     """
 
-    v0 = [16.7905,16.7906,16.7984,16.8238,16.8550,16.8885,16.9232,16.959,16.9956,17.0329,17.071,17.1098]
-    k0 = [180.93,180.93,179.94,177.51,174.86,172.16,169.43,166.7,163.96,161.21,158.46,155.7]
-    kp0 = [6.08,6.08,6.09,6.11,6.13,6.15,6.17,6.20,6.23,6.25,6.28,6.31]
-    temp0 = [0,10,50,100,150,200,250,300,350,400,450,500]
-
-    try:
-        v0_out = float(interp1d(temp0,v0,kind='linear')(temperature))
-        k0_out = float(interp1d(temp0,k0,kind='linear')(temperature))
-        kp0_out = float(interp1d(temp0,kp0,kind='linear')(temperature))
-        return v0_out,k0_out,kp0_out
-    except ValueError:
-        print('ERROR! Temperature must be between 5-500K, but {:0.1f} was entered!'.format(temperature))
+    eos = get_eos('Au')
+    v0_out,k0_out,kp0_out = eos.parameters(temperature)
+    if np.isnan(v0_out):
+        print('ERROR! Temperature must be between {:0.0f}-{:0.0f}K, but {:0.1f} was entered!'.format(
+            eos.temperature[0],eos.temperature[-1],temperature))
         return 0
+    return float(v0_out),float(k0_out),float(kp0_out)
 
 def calculate_pressure(tth, temperature, energy, bragg_peak, calibrant, tth_off = 0.0):
-    """Calculate the pressure using diffraction from Au or Ag.
+    """Calculate the pressure using diffraction from a calibrant, e.g. Au or Ag.
 
     Parameters
     -----------
@@ -239,11 +1979,11 @@ def calculate_pressure(tth, temperature, energy, bragg_peak, calibrant, tth_off
         X-ray energy used in keV.
 
     bragg_peak: string
-        Pick the Bragg peak that will be used in the calibration. Current options are
-    '111', '200', '220'.
+        Pick the Bragg peak that will be used in the calibration (e.g. '111', '200',
+    '220'). It must be allowed by the lattice of the calibrant.
 
     calibrant: string
-        Selects the calibrant used. Options are 'Au' or 'Ag'.
+        Selects the calibrant used, a key of CALIBRANTS (e.g. 'Au' or 'Ag').
 
     tth_off: float (Optional)
         Offset between the reference two theta and the measured value.
@@ -251,46 +1991,852 @@ def calculate_pressure(tth, temperature, energy, bragg_peak, calibrant, tth_off
     Returns
     -----------
     pressure: float
-        Calculated pressure in GPa.
+        Calculated pressure in GPa. If the pressure cannot be calculated, a message
+    with the reason is returned.
     """
     ## Constants ##
-    afg = 2337 #GPa.AA^5
     h = 4.135667662E-15 #eV.s
     c = 299792458E10 #AA/s
 
     ## Loading parameters ##
-    if calibrant == 'Au':
-        z = 79
-        #a0_th = 4.07837
-        v0,k0,kp0 = load_au_params(temperature)
-    elif calibrant == 'Ag':
-        return 'Ag calibrant is not setup yet!!!'
-        
-
-    ## Calculate atomic volume
+    if calibrant not in CALIBRANTS:
+        return 'Could not recognize the {} calibrant. It must be one of {}.'.format(
+            calibrant,', '.join(CALIBRANTS))
+    eos = get_eos(calibrant)
+    low,high = eos.temperature[0],eos.temperature[-1]
+    if np.isscalar(temperature):
+        outside = [] if low <= temperature <= high else [temperature]
+    else:
+        temperatures = np.asarray(temperature)
+        outside = temperatures[~((temperatures >= low) & (temperatures <= high))]
+    if len(outside) > 0:
+        return 'Temperature must be between {:0.0f}-{:0.0f}K, but {:0.1f} was entered!'.format(
+            low,high,float(outside[0]))
+
+    lattice = CALIBRANTS[calibrant].lattice
+    if not reflection_allowed(lattice,bragg_peak):
+        return ('Could not recognize the {} bragg peak. It must be a reflection of the {} lattice, '
+                'such as "111", "200", or "220".'.format(bragg_peak,lattice))
+
+    ## Calculate lattice parameter
     lamb = h*c/energy/1000.
     d = lamb/2/np.sin((tth-tth_off)/2.*np.pi/180.)
+    a = d*np.sqrt(sum(index**2 for index in miller_indices(bragg_peak)))
+
+    ## Calculate pressure
+    pressure = eos.lattice_pressure(a,temperature)
+
+    return pressure
+
+PRESSURE_STATUS = ['ok','unknown calibrant','unknown bragg peak','temperature out of range','invalid input']
+"""Meaning of the status codes returned by calculate_pressure_array."""
+
+def calculate_pressure_array(tth,temperature,energy,bragg_peak='111',calibrant='Au',tth_off=0.0):
+    """Calculates the pressure of arrays of peaks, see calculate_pressure.
+
+    All parameters are broadcast against each other, so each element can have
+    its own temperature, energy, Bragg peak and calibrant. Each calibrant is
+    calculated with a single call to its CalibrantEOS.
+
+    Parameters
+    -----------
+    tth: float or np.ndarray
+        Two theta of the Bragg peaks.
+
+    temperature: float or np.ndarray
+        Measurement temperatures in Kelvin.
+
+    energy: float or np.ndarray
+        X-ray energies used in keV.
+
+    bragg_peak: string or np.ndarray (Optional)
+        Bragg peaks, which must be allowed by the lattice of the calibrant.
+
+    calibrant: string or np.ndarray (Optional)
+        Calibrants used, keys of CALIBRANTS.
+
+    tth_off: float or np.ndarray (Optional)
+        Offset between the reference two theta and the measured value.
+
+    Returns
+    -----------
+    pressure: np.ndarray
+        Calculated pressures in GPa, NaN where they could not be calculated.
+
+    status: np.ndarray
+        Array of int8 with the index in PRESSURE_STATUS of the result of each element.
+    If there are several problems, the first one in PRESSURE_STATUS is given.
+    """
+
+    # The equation of state gets the temperature before broadcasting, so that the
+    # constants of a single temperature are reused.
+    eos_temperature = np.asarray(temperature,dtype=np.float64)
+    names = np.unique(calibrant)
+    peaks = np.unique(bragg_peak)
+    tth,temperature,energy,tth_off,bragg_peak,calibrant = np.broadcast_arrays(
+        np.asarray(tth,dtype=np.float64),eos_temperature,
+        np.asarray(energy,dtype=np.float64),np.asarray(tth_off,dtype=np.float64),
+        np.asarray(bragg_peak,dtype=str),np.asarray(calibrant,dtype=str))
+
+    ## Constants ##
+    h = 4.135667662E-15 #eV.s
+    c = 299792458E10 #AA/s
+
+    status = np.zeros(tth.shape,dtype=np.int8)
+    status[~(np.isfinite(tth) & np.isfinite(tth_off) & (energy > 0) & np.isfinite(energy))] = 4
+    pressure = np.full(tth.shape,np.nan)
+
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        ## Calculate lattice parameter
+        lamb = h*c/energy/1000.
+        d = lamb/2/np.sin((tth-tth_off)/2.*np.pi/180.)
+
+        for name in names:
+            select = calibrant == name if len(names) > 1 else np.ones(tth.shape,dtype=bool)
+            if name not in CALIBRANTS:
+                status[select] = 1
+                continue
+            eos = get_eos(name)
+            status[select & ~((temperature >= eos.temperature[0]) & (temperature <= eos.temperature[-1]))] = 3
+
+            index = np.zeros(tth.shape)
+            for peak in peaks:
+                if reflection_allowed(CALIBRANTS[name].lattice,peak):
+                    n2 = sum(value**2 for value in miller_indices(peak))
+                    index[bragg_peak == peak if len(peaks) > 1 else select] = n2
+            status[select & (index == 0)] = 2
+
+            ## Calculate pressure
+            temps = eos_temperature if eos_temperature.ndim == 0 else temperature[select]
+            pressure[select] = eos.lattice_pressure(d[select]*np.sqrt(index[select]),temps)
+
+    status[(status == 0) & ~np.isfinite(pressure)] = 4
+    pressure[status != 0] = np.nan
+    return pressure,status
+
+def tth_from_pressure(pressure,temperature,energy,bragg_peak='111',calibrant='Au',tth_off=0.0):
+    """Predicts the two theta of a Bragg peak at a given pressure, the inverse of calculate_pressure.
+
+    Parameters
+    -----------
+    pressure: float or np.ndarray
+        Pressures in GPa.
+
+    temperature, energy: float or np.ndarray
+        Measurement temperatures in Kelvin and X-ray energies in keV.
+
+    bragg_peak, calibrant, tth_off:
+        See calculate_pressure.
+
+    Returns
+    -----------
+    tth: np.ndarray
+        Two theta of the peaks, NaN where it could not be calculated.
+    """
+
+    if calibrant not in CALIBRANTS:
+        raise ValueError('Could not recognize the {} calibrant.'.format(calibrant))
+    if not reflection_allowed(CALIBRANTS[calibrant].lattice,bragg_peak):
+        raise ValueError('Could not recognize the {} bragg peak.'.format(bragg_peak))
+    eos = get_eos(calibrant)
+    lattice = (eos.units*eos.volume(pressure,temperature))**(1./3.)
+    with np.errstate(invalid='ignore'):
+        return reflection_tth(lattice,np.asarray(energy,dtype=np.float64),bragg_peak,tth_off)
+
+class PressureGrid(object):
+    """Pressure tabulated on a (tth, temperature) grid, for fast repeated lookups.
+
+    The grid is built with calculate_pressure_array for a fixed calibrant,
+    Bragg peak and energy, and lookups use bilinear interpolation. The spacing is
+    refined until the interpolation error bound, h**2/8 times the largest second
+    derivative along each axis (estimated from the grid with a safety factor of
+    2), is below tolerance. The temperatures of the calibrant tables are grid
+    nodes, so the kinks of the linear interpolation of the tables are not smoothed.
+
+    The grid is built on the first lookup after the calibrant, Bragg peak or
+    energy change.
+
+    Parameters
+    -----------
+    calibrant, bragg_peak, energy:
+        See calculate_pressure.
+
+    tth_range: tuple (Optional)
+        Minimum and maximum two theta of the grid. By default it covers lattice
+    parameters from 85% to 101% of the one at ambient pressure.
 
-    if bragg_peak == '111':
-            a = d*np.sqrt(3)
-    elif bragg_peak == '200':
-            a = d*2.
-    elif bragg_peak == '220':
-            a = d*np.sqrt(8)
+    temperature_range: tuple (Optional)
+        Minimum and maximum temperature of the grid. By default it is the range of
+    the calibrant tables.
+
+    tolerance: float (Optional)
+        Maximum interpolation error in GPa.
+
+    max_points: int (Optional)
+        Maximum number of grid points. If it is reached, error_bound is larger than
+    tolerance.
+    """
+
+    def __init__(self,calibrant='Au',bragg_peak='111',energy=20.,tth_range=None,temperature_range=None,
+                 tolerance=1e-3,max_points=2**22):
+
+        self.calibrant = calibrant
+        self.bragg_peak = bragg_peak
+        self.energy = energy
+        self.tth_range = tth_range
+        self.temperature_range = temperature_range
+        self.tolerance = tolerance
+        self.max_points = max_points
+
+        self.tth = None
+        self.temperature = None
+        self.table = None
+        self.error_bound = None
+        self._key = None
+
+    def update(self,**kwargs):
+        """Changes the calibrant, bragg_peak, energy or ranges. The grid is rebuilt on the next lookup."""
+
+        for name,value in kwargs.items():
+            if name not in ['calibrant','bragg_peak','energy','tth_range','temperature_range','tolerance']:
+                raise TypeError('Unknown parameter {}.'.format(name))
+            setattr(self,name,value)
+
+    def key(self):
+        return (self.calibrant,self.bragg_peak,float(self.energy),self.tth_range,self.temperature_range,
+                self.tolerance)
+
+    def build(self):
+        """Calculates the grid, refining it until the error bound is below tolerance."""
+
+        eos = get_eos(self.calibrant)
+        if not reflection_allowed(CALIBRANTS[self.calibrant].lattice,self.bragg_peak):
+            raise ValueError('Could not recognize the {} bragg peak.'.format(self.bragg_peak))
+
+        nodes = eos.temperature
+        if self.temperature_range is not None:
+            low,high = self.temperature_range
+            nodes = np.unique(np.concatenate([[low,high],nodes[(nodes > low) & (nodes < high)]]))
+        tth_range = self.tth_range
+        if tth_range is None:
+            lattice = eos.lattice_parameter(nodes)
+            tth_range = (reflection_tth(1.01*lattice.max(),self.energy,self.bragg_peak),
+                         reflection_tth(0.85*lattice.min(),self.energy,self.bragg_peak))
+
+        ntth,nsplit = 65,2
+        while True:
+            tth = np.linspace(tth_range[0],tth_range[1],ntth)
+            fractions = np.linspace(0,1,nsplit+1)[:-1]
+            temperature = np.append((nodes[:-1,None]+np.diff(nodes)[:,None]*fractions).ravel(),nodes[-1])
+            table,_ = calculate_pressure_array(tth[:,None],temperature,self.energy,self.bragg_peak,self.calibrant)
+
+            # Second derivatives along each axis, without crossing the table nodes.
+            step = tth[1]-tth[0]
+            error_tth = np.nanmax(np.abs(np.diff(table,2,axis=0)))/8.
+            steps = np.diff(temperature)
+            second = np.diff(np.diff(table,axis=1)/steps,axis=1)/(steps[1:]+steps[:-1])*2
+            second[:,nsplit-1::nsplit] = 0.
+            error_temperature = np.nanmax(np.abs(second)*steps.max()**2/8.) if second.size > 0 else 0.
+            error_bound = 2*(error_tth+error_temperature)
+            if error_bound <= self.tolerance or table.size*2 > self.max_points:
+                break
+            if error_tth >= error_temperature:
+                ntth = 2*ntth-1
+            else:
+                nsplit *= 2
+
+        self.tth = tth
+        self.temperature = temperature
+        self.table = table
+        self._flat = table.ravel()
+        self._temperature_list = temperature.tolist()
+        self.error_bound = error_bound
+        self._step = step
+        self._key = self.key()
+
+    def pressure(self,tth,temperature,tth_off=0.0):
+        """Interpolates the pressure.
+
+        Parameters
+        -----------
+        tth: float or np.ndarray
+            Two theta of the Bragg peaks.
+
+        temperature: float or np.ndarray
+            Measurement temperatures in Kelvin.
+
+        tth_off: float (Optional)
+            Offset between the reference two theta and the measured value.
+
+        Returns
+        -----------
+        pressure: np.ndarray
+            Pressures in GPa, NaN outside of the grid.
+        """
+
+        if self._key != self.key():
+            self.build()
+
+        if np.ndim(tth) == 0 and np.ndim(temperature) == 0:
+            return self._scalar_pressure(float(tth)-tth_off,float(temperature))
+
+        # Fractional indices of the points in the grid, NaN outside of it.
+        last = self.tth.size-1
+        nodes = np.arange(self.temperature.size,dtype=np.float64)
+        u = (np.asarray(tth,dtype=np.float64)-tth_off-self.tth[0])*(1./self._step)
+        w = np.interp(temperature,self.temperature,nodes,left=np.nan,right=np.nan)
+        u = np.where((u >= 0) & (u <= last*(1+1e-12)),np.minimum(u,last),np.nan)
+        u,w = np.broadcast_arrays(u,w)
+        i = np.minimum(np.nan_to_num(u).astype(np.intp),self.tth.size-2)
+        j = np.minimum(np.nan_to_num(w).astype(np.intp),self.temperature.size-2)
+        u = u-i
+        w = w-j
+
+        table = self._flat
+        k = i*self.temperature.size+j
+        low = table[k]+w*(table[k+1]-table[k])
+        k += self.temperature.size
+        high = table[k]+w*(table[k+1]-table[k])
+        return low+u*(high-low)
+
+    def _scalar_pressure(self,tth,temperature):
+        # Same as pressure, with python floats.
+        u = (tth-self.tth[0])/self._step
+        last = self.tth.size-1
+        temps = self._temperature_list
+        if not (0 <= u <= last*(1+1e-12) and temps[0] <= temperature <= temps[-1]):
+            return np.nan
+        u = min(u,last)
+        j = min(max(bisect.bisect_right(temps,temperature)-1,0),len(temps)-2)
+        w = (temperature-temps[j])/(temps[j+1]-temps[j])
+        i = min(int(u),last-1)
+        u -= i
+        row = self.table[i:i+2,j:j+2].tolist()
+        low = row[0][0]+w*(row[0][1]-row[0][0])
+        high = row[1][0]+w*(row[1][1]-row[1][0])
+        return low+u*(high-low)
+
+PEAK_ESTIMATORS = ['centroid','parabolic','log-parabolic','caruana']
+
+def estimate_peak_position(x,y,method='caruana'):
+    """Estimates the position of the strongest peak without an iterative fit.
+
+    The background is the minimum of each scan. The methods are:
+
+    'centroid': centroid of the points above half of the maximum, around it.
+    'parabolic': vertex of the parabola through the maximum and its neighbours.
+    'log-parabolic': same as parabolic, but with the logarithm of the data, which
+    is exact for a gaussian peak.
+    'caruana': least squares fit of a parabola to the logarithm of the points above
+    half of the maximum, around it (Caruana's algorithm).
+
+    Only the points next to the maximum are used, so other peaks in the scan do not
+    change the result.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with x values, shared by all scans or with the shape of y.
+
+    y: np.ndarray
+        Array with y values of one scan, or with shape (N, M) for N scans.
+
+    method: string (Optional)
+        One of PEAK_ESTIMATORS.
+
+    Returns
+    -----------
+    x0: float or np.ndarray
+        Position of the peaks, with shape (N,) for N scans.
+    """
+
+    if method not in PEAK_ESTIMATORS:
+        raise ValueError('Unknown method {}, it must be one of {}.'.format(method,', '.join(PEAK_ESTIMATORS)))
+
+    y = np.asarray(y,dtype=np.float64)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    x = np.broadcast_to(np.asarray(x,dtype=np.float64),y.shape)
+
+    y = y-y.min(axis=1,keepdims=True)
+    peak = y.max(axis=1,keepdims=True)
+    tiny = np.finfo(np.float64).tiny
+
+    if method in ['centroid','caruana']:
+        # Points above half of the maximum, up to the first ones below it.
+        index = np.arange(y.shape[1])
+        top = np.argmax(y,axis=1)[:,None]
+        below = y < peak/2.
+        left = np.where(below & (index < top),index,-1).max(axis=1,keepdims=True)
+        right = np.where(below & (index > top),index,y.shape[1]).min(axis=1,keepdims=True)
+        weights = np.where((index > left) & (index < right),y,0.)
+        if method == 'centroid':
+            x0 = (weights*x).sum(axis=1)/weights.sum(axis=1)
+        else:
+            # Normal equations of ln(y) = c0+c1*dx+c2*dx**2, centered on the maximum.
+            use = weights > 0
+            center = np.take_along_axis(x,top,axis=1)[:,0]
+            dx = np.where(use,x-center[:,None],0.)
+            logy = np.where(use,np.log(np.maximum(y,tiny)),0.)
+            powers = [use.sum(axis=1),dx.sum(axis=1)]
+            moments = [logy.sum(axis=1),(logy*dx).sum(axis=1)]
+            dxk = dx
+            for k in range(2,5):
+                dxk = dxk*dx
+                powers.append(dxk.sum(axis=1))
+                if k == 2:
+                    moments.append((logy*dxk).sum(axis=1))
+            matrix = np.stack([np.stack(powers[i:i+3],axis=-1) for i in range(3)],axis=1)
+            # Peaks with less than three points are at the maximum. The determinant
+            # is not exactly zero for them, so it cannot be used to find them.
+            singular = use.sum(axis=1) < 3
+            matrix[singular] = np.eye(3)
+            coeffs = np.linalg.solve(matrix,np.stack(moments,axis=-1)[...,None])[...,0]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                x0 = np.where(singular|(coeffs[:,2] >= 0),center,center-coeffs[:,1]/2./coeffs[:,2])
     else:
-        return 'Could not recognize the {} bragg peak. It must be "111", "200", or "220".'.format(bragg_peak)
+        index = np.clip(np.argmax(y,axis=1),1,y.shape[1]-2)[:,None]
+        xs = [np.take_along_axis(x,index+i,axis=1)[:,0] for i in (-1,0,1)]
+        ys = [np.take_along_axis(y,index+i,axis=1)[:,0] for i in (-1,0,1)]
+        if method == 'log-parabolic':
+            ys = [np.log(np.maximum(yi,tiny)) for yi in ys]
+        # Vertex of the parabola through the three points.
+        d1 = (ys[1]-ys[0])*(xs[2]**2-xs[1]**2)-(ys[2]-ys[1])*(xs[1]**2-xs[0]**2)
+        d2 = (ys[1]-ys[0])*(xs[2]-xs[1])-(ys[2]-ys[1])*(xs[1]-xs[0])
+        with np.errstate(divide='ignore',invalid='ignore'):
+            x0 = np.where(d2 != 0,0.5*d1/d2,xs[1])
+
+    return x0[0] if single else x0
+
+def estimate_pressure(x,y,temperature,energy,bragg_peak,calibrant,method='caruana',tth_off=0.0):
+    """Calculates the pressure from the peak position given by estimate_peak_position.
 
-    v = a**3/4.
+    Parameters
+    -----------
+    x, y, method:
+        See estimate_peak_position.
 
-    ## Calculate pressure
-    x = (v/v0)**0.3333
-    pfg0 = afg*(z/v0)**1.6666
-    c0 = -1*np.log(3*k0/pfg0)
-    c2 = (3/2)*(kp0-3)-c0
+    temperature, energy, bragg_peak, calibrant, tth_off:
+        See calculate_pressure_array. They can have one value per scan.
+
+    Returns
+    -----------
+    pressure: float or np.ndarray
+        Calculated pressure in GPa, NaN where it could not be calculated.
 
-    pressure = 3*k0*(1-x)/x**5*np.exp(c0*(1-x))*(1+c2*x*(1-x))
+    x0: float or np.ndarray
+        Estimated peak positions.
 
-    return pressure
+    status: int or np.ndarray
+        Index of PRESSURE_STATUS for each scan, 0 if the pressure was calculated.
+    """
+
+    x0 = estimate_peak_position(x,y,method=method)
+    pressure,status = calculate_pressure_array(x0,temperature,energy,bragg_peak,calibrant,tth_off=tth_off)
+    if np.ndim(x0) == 0 and pressure.ndim == 0:
+        return float(pressure),x0,int(status)
+    return pressure,x0,status
+
+MultiPeakFit = namedtuple('MultiPeakFit',['lattice','lattice_error','pressure','popt'])
+MultiPeakFit.__doc__ = """Result of fit_multi_peak.
+
+lattice: float
+    Cubic lattice parameter in Angstroms.
+
+lattice_error: float
+    Standard error of the lattice parameter.
+
+pressure: float
+    Pressure in GPa calculated from the lattice parameter, NaN if it could not be
+calculated.
+
+popt: np.ndarray
+    Array with shape (N, 5) with the pseudo-voigt parameters of each reflection. The
+constant is shared.
+"""
+
+def reflection_tth(lattice,energy,bragg_peak,tth_off=0.0):
+    """Two theta of a reflection of a cubic lattice.
+
+    Parameters
+    -----------
+    lattice: float or np.ndarray
+        Lattice parameter in Angstroms.
+
+    energy: float
+        X-ray energy used in keV.
+
+    bragg_peak: string
+        Miller indices of the reflection (e.g. '111').
+
+    tth_off: float (Optional)
+        Offset between the reference two theta and the measured value.
+
+    Returns
+    -----------
+    tth: float or np.ndarray
+        Two theta in degrees.
+    """
+
+    h = 4.135667662E-15 #eV.s
+    c = 299792458E10 #AA/s
+    lamb = h*c/energy/1000.
+    d = lattice/np.sqrt(sum(index**2 for index in miller_indices(bragg_peak)))
+    return 2*np.arcsin(lamb/2/d)*180/np.pi+tth_off
+
+def fit_multi_peak(x,y,energy,temperature=300.,calibrant='Au',reflections=('111','200','220'),
+                   shared_lattice=True,lattice=None,fit_alpha=True,alpha_guess=0.5,tth_off=0.0):
+    """Fits several reflections of the calibrant in one scan and calculates the pressure.
+
+    The reflections are pseudo-voigt peaks with their own width and amplitude, a
+    shared alpha and a shared constant background. If shared_lattice is True, the
+    peak positions are given by a single cubic lattice parameter. Otherwise each
+    position is fitted, and the lattice parameter is the weighted mean of the ones
+    from each reflection.
+
+    The initial lattice parameter is the one for which the data at the reflections
+    is largest, searched between 85% and 101% of the initial guess.
+
+    Parameters
+    -----------
+    x: np.ndarray
+        Array with two theta values.
+
+    y: np.ndarray
+        Array with y values.
+
+    energy, temperature, calibrant, tth_off:
+        See calculate_pressure.
+
+    reflections: list (Optional)
+        Miller indices of the reflections in the scan.
+
+    shared_lattice: boolean (Optional)
+        If True, a single lattice parameter is fitted.
+
+    lattice: float (Optional)
+        Initial guess of the lattice parameter. By default it is the ambient pressure
+    lattice parameter of the calibrant at the given temperature.
+
+    fit_alpha, alpha_guess:
+        See fit_pseudo_voigt.
+
+    Returns
+    -----------
+    result: MultiPeakFit
+        Fitted lattice parameter, pressure and peaks.
+
+    Raises
+    -----------
+    ValueError
+        If the calibrant is unknown, a reflection is not allowed by its lattice or
+    is outside of the scan, or the temperature is out of the range of its tables.
+    """
+
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    npeaks = len(reflections)
+    if npeaks == 0:
+        raise ValueError('At least one reflection is needed.')
+    if calibrant not in CALIBRANTS:
+        raise ValueError('Could not recognize the {} calibrant.'.format(calibrant))
+    for hkl in reflections:
+        if not reflection_allowed(CALIBRANTS[calibrant].lattice,hkl):
+            raise ValueError('Could not recognize the {} bragg peak.'.format(hkl))
+    eos = get_eos(calibrant)
+    if not eos.temperature[0] <= temperature <= eos.temperature[-1]:
+        raise ValueError('Temperature must be between {:0.0f}-{:0.0f}K, but {:0.1f} was entered!'.format(
+            eos.temperature[0],eos.temperature[-1],temperature))
+    if lattice is None:
+        lattice = eos.lattice_parameter(temperature)
+
+    # Search for the lattice parameter.
+    p0,_ = find_peak_window(x,y)
+    background = y-p0[3]
+    trials = lattice*np.linspace(0.85,1.01,2001)
+    positions = np.array([reflection_tth(trials,energy,hkl,tth_off) for hkl in reflections])
+    score = np.interp(positions,x,background,left=0.,right=0.).sum(axis=0)
+    lattice = trials[np.argmax(score)]
+
+    x0 = np.array([reflection_tth(lattice,energy,hkl,tth_off) for hkl in reflections])
+    outside = [hkl for hkl,position in zip(reflections,x0) if not x.min() <= position <= x.max()]
+    if len(outside) > 0:
+        raise ValueError('The {} reflections are outside of the scan.'.format(', '.join(outside)))
+    heights = np.maximum(np.interp(x0,x,background),0.)
+    sigma = np.full(npeaks,p0[1])
+    amplitude = heights*sigma*np.sqrt(np.pi/np.log(2))
+    nposition = 1 if shared_lattice else npeaks
+    theta = np.concatenate([[lattice] if shared_lattice else x0,sigma,amplitude,[p0[3]],
+                            [alpha_guess] if fit_alpha else []])
+
+    xcol = x[:,None]
+    sqrt_n = np.array([np.sqrt(sum(index**2 for index in miller_indices(hkl))) for hkl in reflections])
+    h = 4.135667662E-15 #eV.s
+    c = 299792458E10 #AA/s
+    lamb = h*c/energy/1000.
+
+    def unpack(theta):
+        alpha = theta[-1] if fit_alpha else alpha_guess
+        if shared_lattice:
+            positions = 2*np.arcsin(lamb*sqrt_n/2/theta[0])*180/np.pi+tth_off
+        else:
+            positions = theta[:npeaks]
+        return (positions,theta[nposition:nposition+npeaks],theta[nposition+npeaks:nposition+2*npeaks],
+                theta[nposition+2*npeaks],alpha)
+
+    def residuals(theta):
+        positions,sigma,amplitude,constant,alpha = unpack(theta)
+        return pseudo_voigt(xcol,positions,sigma,amplitude,0.,alpha).sum(axis=1)+constant-y
+
+    def jacobian(theta):
+        positions,sigma,amplitude,constant,alpha = unpack(theta)
+        d_x0,d_sigma,d_amplitude,_,d_alpha = pseudo_voigt_derivatives(xcol,positions,sigma,amplitude,0.,alpha)
+        if shared_lattice:
+            s = lamb*sqrt_n/2/theta[0]
+            d_x0 = d_x0.dot(-2*180/np.pi*s/theta[0]/np.sqrt(1-s**2))[:,None]
+        columns = [d_x0,d_sigma,d_amplitude,np.ones((x.size,1))]
+        if fit_alpha:
+            columns.append(d_alpha.sum(axis=1)[:,None])
+        return np.hstack(columns)
+
+    result = least_squares(residuals,theta,jac=jacobian,method='lm')
+    if not result.success:
+        raise RuntimeError('Optimal parameters not found: '+result.message)
+
+    # Covariance of the parameters.
+    dof = max(x.size-result.x.size,1)
+    covariance = np.linalg.pinv(result.jac.T.dot(result.jac))*2*result.cost/dof
+    positions,sigma,amplitude,constant,alpha = unpack(result.x)
+    if shared_lattice:
+        lattice = result.x[0]
+        lattice_error = np.sqrt(covariance[0,0])
+    else:
+        # Lattice parameters of each reflection and their errors.
+        angle = (positions-tth_off)/2*np.pi/180
+        lattices = lamb*sqrt_n/2/np.sin(angle)
+        errors = lattices/np.tan(angle)*np.pi/360*np.sqrt(np.diag(covariance)[:npeaks])
+        weights = 1./np.maximum(errors,np.finfo(np.float64).tiny)**2
+        lattice = (weights*lattices).sum()/weights.sum()
+        lattice_error = 1./np.sqrt(weights.sum())
+
+    popt = np.column_stack([positions,np.abs(sigma),amplitude,np.full(npeaks,constant),np.full(npeaks,alpha)])
+    pressure = eos.lattice_pressure(lattice,temperature)
+    return MultiPeakFit(lattice,lattice_error,float(pressure),popt)
+
+def global_fit_pressure(x,y,temperature,energy,bragg_peak='111',calibrant='Au',tth_off=0.0,fit_alpha=True,
+                        alpha_guess=0.5):
+    """Fits a series of scans with fit_pseudo_voigt_global and calculates their pressures.
+
+    Parameters
+    -----------
+    x, y, fit_alpha, alpha_guess:
+        See fit_pseudo_voigt_global.
+
+    temperature, energy: float or list
+        Temperature and energy of all scans or of each scan, see calculate_pressure.
+
+    bragg_peak, calibrant, tth_off:
+        See calculate_pressure.
+
+    Returns
+    -----------
+    pressure: np.ndarray
+        Pressure of each scan, NaN where it could not be calculated.
+
+    popt: np.ndarray
+        Array with shape (N, 5) with the optimized parameters of each scan.
+    """
+
+    popt = fit_pseudo_voigt_global(x,y,fit_alpha=fit_alpha,alpha_guess=alpha_guess)
+    pressure,_ = calculate_pressure_array(popt[:,0],temperature,energy,bragg_peak,calibrant,tth_off=tth_off)
+    return pressure,popt
+
+FIT_TABLE_DTYPE = [('scan','U16'),('x0','f8'),('sigma','f8'),('amplitude','f8'),('constant','f8'),
+                   ('alpha','f8'),('window_min','f8'),('window_max','f8'),('temperature','f8'),
+                   ('energy','f8'),('pressure','f8'),('fitted','?')]
+
+def fit_scans(fname,state,scan_numbers,options):
+    """Loads, fits and calculates the pressure of a list of scans.
+
+    This is the job that fit_spec_file sends to each process.
+
+    Parameters
+    -----------
+    fname: string
+        Path to the spec file.
+
+    state: dict
+        Index of the spec file, see SpecFile.get_state.
+
+    scan_numbers: list
+        Numbers of the scans.
+
+    options: dict
+        Keyword arguments of fit_spec_file that control the fit and pressure.
+
+    Returns
+    -----------
+    rows: list
+        One tuple per scan with the fields of FIT_TABLE_DTYPE.
+    """
+
+    spec = SpecFile(fname,state=state,beamline=options['beamline'])
+    rows = []
+    previous = None
+    for scan_number in scan_numbers:
+        popt = np.full(5,np.nan)
+        window = (np.nan,np.nan)
+        temperature = energy = pressure = np.nan
+        fitted = False
+        try:
+            x,y,temperatures,energy = load_scan(spec,scan_number,options['x_label'],options['y_label'],
+                                                norm_column=options['norm_column'])
+            temperature = temperatures.get(options['temperature_source'],np.nan)
+            p0 = None
+            window = (x.min(),x.max())
+            if options['window'] is not None:
+                # Stays NaN if the expected peak is not in the scan.
+                window = (np.nan,np.nan)
+                center = None
+                if options['expected_pressure'] is not None:
+                    center = tth_from_pressure(options['expected_pressure'],temperature,energy,
+                                               options['bragg_peak'],options['calibrant'],
+                                               tth_off=options['tth_off'])
+                    center = None if np.isnan(center) else float(center)
+                p0,window = find_peak_window(x,y,width=options['window'],center=center,search=options['search'])
+                p0[4] = options['alpha_guess']
+                index = (x >= window[0]) & (x <= window[1])
+                x,y = x[index],y[index]
+            if options['warm_start']:
+                popt,_ = fit_pseudo_voigt_series([x],[y],p0=p0 if previous is None else previous,
+                                                 fit_alpha=options['fit_alpha'],alpha_guess=options['alpha_guess'])
+                popt = popt[0]
+                if np.isnan(popt[0]):
+                    raise RuntimeError('fit failed')
+                previous = popt
+            else:
+                popt = fit_pseudo_voigt(x,y,p0=p0,fit_alpha=options['fit_alpha'],
+                                        alpha_guess=options['alpha_guess'])
+            fitted = True
+            output = calculate_pressure(popt[0],temperature,energy,options['bragg_peak'],
+                                        options['calibrant'],tth_off=options['tth_off'])
+            if type(output) is not str and output is not None:
+                pressure = output
+        except (KeyError,ValueError,IndexError,TypeError,RuntimeError):
+            pass
+        rows.append((str(scan_number),)+tuple(popt)+tuple(window)+(temperature,energy,pressure,fitted))
+    return rows
+
+def fit_spec_file(fname,scan_numbers,x_label,y_label,bragg_peak='111',calibrant='Au',
+                  temperature_source='Sample',norm_column=None,fit_alpha=True,alpha_guess=0.5,
+                  tth_off=0.0,beamline='4-ID-D',warm_start=False,window=None,expected_pressure=None,search=0.5,
+                  state=None,workers=None,chunksize=None,progress=None):
+    """Fits every scan of a spec file and calculates their pressures in parallel.
+
+    The scans are split in chunks, and each chunk is sent to a process of a
+    concurrent.futures.ProcessPoolExecutor, which runs load_scan, fit_pseudo_voigt
+    and calculate_pressure for each scan. The processes are started with spawn, since
+    forking a process with other threads (e.g. the GUI) can deadlock.
+
+    Parameters
+    -----------
+    fname: string
+        Path to the spec file.
+
+    scan_numbers: list
+        Numbers of the scans to be fitted. If None, all scans are fitted.
+
+    x_label, y_label, norm_column: string
+        Columns used, see load_scan.
+
+    bragg_peak, calibrant, tth_off:
+        See calculate_pressure.
+
+    temperature_source: string (Optional)
+        Name of the temperature used, see get_temperature.
+
+    fit_alpha, alpha_guess:
+        See fit_pseudo_voigt.
+
+    beamline: string (Optional)
+        Key of BEAMLINE_HEADERS used to read the scan metadata.
+
+    warm_start: boolean (Optional)
+        If True, each fit starts from the result of the previous scan in the same
+    chunk, see fit_pseudo_voigt_series.
+
+    window: float (Optional)
+        If given, only the data within window FWHM of the strongest peak is fitted,
+    see find_peak_window. The fitted range is stored in window_min and window_max.
+
+    expected_pressure: float (Optional)
+        If given with window, the peak is searched within search degrees of its
+    position at this pressure, see tth_from_pressure. Scans without data there are
+    not fitted, and their window_min and window_max are NaN.
+
+    state: dict (Optional)
+        Index of the spec file already read, see SpecFile.get_state. If given, only
+    the part of the file written after it is indexed.
+
+    workers: int (Optional)
+        Number of processes. If None, uses the number of CPUs. If 1, runs in this process.
+
+    chunksize: int (Optional)
+        Number of scans sent to a process at a time. If None, each process gets
+    about four chunks.
+
+    progress: function (Optional)
+        Called with the fraction of chunks done.
+
+    Returns
+    -----------
+    table: np.ndarray
+        Structured array with FIT_TABLE_DTYPE and one row per scan, in the order of
+    scan_numbers. Fields that could not be found are NaN, and fitted is False for
+    the scans where the fit failed.
+    """
+
+    spec = SpecFile(fname,beamline=beamline,state=state)
+    if scan_numbers is None:
+        scan_numbers = spec.getScanNumbers()
+    scan_numbers = [str(number) for number in scan_numbers]
+
+    options = dict(x_label=x_label,y_label=y_label,norm_column=norm_column,bragg_peak=bragg_peak,
+                   calibrant=calibrant,temperature_source=temperature_source,fit_alpha=fit_alpha,
+                   alpha_guess=alpha_guess,tth_off=tth_off,beamline=beamline,warm_start=warm_start,
+                   window=window,expected_pressure=expected_pressure,search=search)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1,-(-len(scan_numbers)//(4*workers)))
+    chunks = [scan_numbers[i:i+chunksize] for i in range(0,len(scan_numbers),chunksize)]
+    # Starting a process takes long, so there are no more processes than chunks.
+    workers = max(1,min(workers,len(chunks)))
+
+    state = spec.get_state()
+    results = [None]*len(chunks)
+    if workers == 1:
+        for i,chunk in enumerate(chunks):
+            results[i] = fit_scans(fname,state,chunk,options)
+            if progress is not None:
+                progress(float(i+1)/len(chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(fit_scans,fname,state,chunk,options):i for i,chunk in enumerate(chunks)}
+            for done,future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress(float(done+1)/len(chunks))
+
+    rows = [row for chunk in results for row in chunk]
+    return np.array(rows,dtype=FIT_TABLE_DTYPE)
+
+def save_fit_table(fname,table):
+    """Saves the table from fit_spec_file as a text file with one scan per line."""
+    header = ' '.join(name for name,_ in FIT_TABLE_DTYPE)
+    fmt = ['%s']+['%.6g']*(len(FIT_TABLE_DTYPE)-2)+['%d']
+    np.savetxt(fname,table,fmt=fmt,header=header)
 
 def plot_data(fig,canvas,x,y,clear=True,xlabel='',ylabel=''):
     ''' plot some random stuff '''
@@ -43,6 +43,10 @@ class MainWindow(QMainWindow):
         
         self.connections = LogicWidgets(self.statusBar(),self.options_widget,self.plot_widget)
         
+    def closeEvent(self,event):
+        self.connections.close()
+        super(MainWindow,self).closeEvent(event)
+        
         
     def build_menu(self):
 
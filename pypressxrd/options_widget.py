@@ -4,7 +4,7 @@
 '''
 
 from PyQt5.QtWidgets import QApplication, QWidget,QGroupBox,QComboBox
-from PyQt5.QtWidgets import QLabel,QTextEdit,QPushButton,QRadioButton
+from PyQt5.QtWidgets import QLabel,QTextEdit,QPushButton,QRadioButton,QCheckBox
 from PyQt5.QtWidgets import QGridLayout,QVBoxLayout,QHBoxLayout
 
 from PyQt5.QtCore import Qt
@@ -43,6 +43,8 @@ class SpecWidget(QGroupBox):
 
         self.load_button = QPushButton('Load')
         self.reload_button = QPushButton('Reload')
+        self.follow_box = QCheckBox('Follow')
+        self.follow_box.setToolTip('Load new scans as they are written, then fit them and calculate the pressure.')
         self.fname_label = QLabel('File name:')
         self.fname = QLabel('')
     
@@ -51,8 +53,9 @@ class SpecWidget(QGroupBox):
         self._layout = QGridLayout()
         self._layout.addWidget(self.load_button,0,0)
         self._layout.addWidget(self.reload_button,0,1)
+        self._layout.addWidget(self.follow_box,0,2)
         self._layout.addWidget(self.fname_label,1,0)
-        self._layout.addWidget(self.fname,1,1)
+        self._layout.addWidget(self.fname,1,1,1,2)
         
         self.setLayout(self._layout)
 
@@ -229,6 +232,8 @@ class PressureWidget(QGroupBox):
         self.hkl_box.addItems(['111','200','220'])
         
         self.pressure_button = QPushButton('Calculate Pressure')
+        self.fit_all_button = QPushButton('Fit All Scans')
+        self.fit_all_button.setToolTip('Fit every scan and save their pressures to a file.')
         
         self.print_pressure = QLabel('')
         self.print_pressure.setStyleSheet('color: red')
@@ -252,6 +257,7 @@ class PressureWidget(QGroupBox):
         self._layout.addLayout(self._mano_layout)
         self._layout.addLayout(self._hkl_layout)
         self._layout.addWidget(self.pressure_button)
+        self._layout.addWidget(self.fit_all_button)
         self._layout.addWidget(self.print_pressure)
         
         self.setLayout(self._layout)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from pypressxrd.logic import pseudo_voigt
+
+
+HEADER = '''#F test.spec
+#E 1538000000
+#D Wed Sep 26 12:00:00 2018
+#C test  User = user
+#O0 tth  th  chi  phi
+
+'''
+
+
+def make_scan(number, x0=11.0, npts=41, temperature=300.0, energy=20.0):
+    "Text of a 4-ID-D like scan of an Au peak centered at x0."
+    x = np.linspace(x0-0.5, x0+0.5, npts)
+    y = pseudo_voigt(x, x0, 0.05, 100., 10., 0.5)
+    lines = ['#S {:d}  ascan  tth {:.3f} {:.3f} {:d} 1'.format(number, x[0], x[-1], npts-1),
+             '#D Wed Sep 26 12:{:02d}:00 2018'.format(number % 60),
+             '#T 1  (Seconds)',
+             '#G0 0',
+             '#X Control: {:.1f}K  Sample: {:.1f}K'.format(temperature, temperature-0.5),
+             '#C Energy: {:.4f} eV'.format(energy),
+             '#N 4',
+             '#L tth  Seconds  Monitor  Detector']
+    for xi, yi in zip(x, y):
+        lines.append('{:.4f} 1 1000 {:.3f}'.format(xi, yi))
+    return '\n'.join(lines)+'\n\n'
+
+
+@pytest.fixture
+def spec_fname(tmp_path):
+    "Spec file with three Au scans at increasing pressure."
+    fname = tmp_path / 'test.spec'
+    fname.write_text(HEADER+''.join(make_scan(i, x0=11.0+0.1*i) for i in range(1, 4)))
+    return str(fname)
@@ -0,0 +1,235 @@
+import numpy as np
+import pytest
+
+from pypressxrd.logic import (PEAK_ESTIMATORS, PRESSURE_STATUS, PseudoVoigtEvaluator, calculate_pressure,
+                              estimate_peak_position, estimate_pressure, find_peak_window, fit_multi_peak,
+                              fit_pseudo_voigt, fit_pseudo_voigt_batch, fit_pseudo_voigt_global,
+                              fit_pseudo_voigt_series, fit_pseudo_voigt_varpro, fit_pseudo_voigt_window,
+                              global_fit_pressure, load_au_params, pseudo_voigt, pseudo_voigt_jacobian,
+                              reflection_tth)
+
+
+@pytest.fixture
+def peak():
+    "Noisy pseudo-voigt peak and its parameters."
+    rng = np.random.RandomState(0)
+    params = [11.2, 0.05, 100., 10., 0.3]
+    x = np.linspace(10.7, 11.7, 101)
+    y = pseudo_voigt(x, *params)+rng.normal(0, 1., x.size)
+    return x, y, params
+
+
+def test_pseudo_voigt_evaluator():
+    x = np.linspace(10.5, 11.5, 51)
+    evaluator = PseudoVoigtEvaluator(x)
+    out = np.empty_like(x)
+    for params in [(11.02, 0.07, 80., 5., 0.4), (10.9, -0.03, 10., 0., 1.)]:
+        np.testing.assert_allclose(evaluator.evaluate(*params), pseudo_voigt(x, *params), rtol=1e-12)
+        assert evaluator.evaluate(*params, out=out) is out
+        np.testing.assert_allclose(evaluator(x[::2], *params), pseudo_voigt(x[::2], *params), rtol=1e-12)
+        assert evaluator(x, *params, out=out) is out
+
+    # Results of calls are not overwritten by the next call.
+    first = evaluator(x, 11.02, 0.07, 80., 5., 0.4)
+    evaluator(x, 10.9, 0.03, 10., 0., 1.)
+    np.testing.assert_allclose(first, pseudo_voigt(x, 11.02, 0.07, 80., 5., 0.4), rtol=1e-12)
+
+
+def test_pseudo_voigt_jacobian_matches_finite_differences():
+    x = np.linspace(10.5, 11.5, 51)
+    params = np.array([11.02, 0.07, 80., 5., 0.4])
+    jacobian = pseudo_voigt_jacobian(x, *params)
+    for i in range(5):
+        step = np.zeros(5)
+        step[i] = 1e-6*max(abs(params[i]), 1.)
+        numeric = (pseudo_voigt(x, *(params+step))-pseudo_voigt(x, *(params-step)))/2/step[i]
+        np.testing.assert_allclose(jacobian[:, i], numeric, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('fit_alpha', [True, False])
+def test_fit_pseudo_voigt_jacobian(peak, fit_alpha):
+    x, y, params = peak
+    popt = fit_pseudo_voigt(x, y, fit_alpha=fit_alpha, alpha_guess=0.3)
+    np.testing.assert_allclose(popt, fit_pseudo_voigt(x, y, fit_alpha=fit_alpha, alpha_guess=0.3, jac=False),
+                               rtol=1e-4)
+    assert abs(popt[0]-params[0]) < 1e-3
+
+
+def test_fit_pseudo_voigt_batch(peak):
+    x, _, params = peak
+    rng = np.random.RandomState(1)
+    centers = np.linspace(11.0, 11.4, 6)
+    scans = [pseudo_voigt(x, x0, *params[1:])+rng.normal(0, 1., x.size) for x0 in centers]
+
+    popt, converged = fit_pseudo_voigt_batch(x, np.array(scans))
+    assert converged.all()
+    for y, p in zip(scans, popt):
+        np.testing.assert_allclose(p, fit_pseudo_voigt(x, y), rtol=1e-4, atol=1e-6)
+
+    # Ragged scans with fixed alpha.
+    xs = [x[i:] for i in range(6)]
+    ys = [y[i:] for i, y in enumerate(scans)]
+    popt, converged = fit_pseudo_voigt_batch(xs, ys, fit_alpha=False, alpha_guess=0.3)
+    assert converged.all()
+    assert (popt[:, 4] == 0.3).all()
+    for xi, yi, p in zip(xs, ys, popt):
+        np.testing.assert_allclose(p, fit_pseudo_voigt(xi, yi, fit_alpha=False, alpha_guess=0.3),
+                                   rtol=1e-4, atol=1e-6)
+
+
+def test_fit_pseudo_voigt_series(peak):
+    x, _, params = peak
+    rng = np.random.RandomState(2)
+    centers = np.linspace(11.0, 11.4, 8)
+    scans = [pseudo_voigt(x, x0, *params[1:])+rng.normal(0, 1., x.size) for x0 in centers]
+    # A scan without a peak is a bad guess for the next one, which is refitted from scratch.
+    scans.insert(4, rng.normal(0, 1., x.size))
+
+    popt, warm = fit_pseudo_voigt_series(x, scans, extrapolate=True)
+    assert not warm[0] and warm[1:4].all()
+    for i, y in enumerate(scans):
+        if i == 4:
+            continue
+        np.testing.assert_allclose(popt[i], fit_pseudo_voigt(x, y), rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('fit_alpha', [True, False])
+def test_fit_pseudo_voigt_varpro(peak, fit_alpha):
+    x, y, params = peak
+    popt = fit_pseudo_voigt_varpro(x, y, fit_alpha=fit_alpha, alpha_guess=0.3)
+    np.testing.assert_allclose(popt, fit_pseudo_voigt(x, y, fit_alpha=fit_alpha, alpha_guess=0.3),
+                               rtol=1e-5, atol=1e-6)
+    # A poor initial width still converges to the same peak.
+    popt = fit_pseudo_voigt_varpro(x, y, p0=[11.1, 0.2], fit_alpha=fit_alpha, alpha_guess=0.3)
+    assert abs(popt[0]-params[0]) < 1e-3
+
+
+def test_fit_pseudo_voigt_window():
+    rng = np.random.RandomState(3)
+    x = np.linspace(10., 20., 2001)
+    # Calibrant peak next to a broader sample peak.
+    y = pseudo_voigt(x, 15.1, 0.03, 10., 5., 0.3)+pseudo_voigt(x, 15.35, 0.1, 10., 0., 0.5)
+    y += rng.normal(0, 1., x.size)
+
+    p0, window = find_peak_window(x, y)
+    assert abs(p0[0]-15.1) < 0.01
+    assert 0.02 < p0[1] < 0.05
+    np.testing.assert_allclose(window, [p0[0]-8*p0[1], p0[0]+8*p0[1]])
+
+    popt, window = fit_pseudo_voigt_window(x, y, width=4.)
+    assert abs(popt[0]-15.1) < 1e-3
+    assert window[1] < 15.35
+
+    # The expected position selects the sample peak.
+    p0, window = find_peak_window(x, y, center=15.4, search=0.1)
+    assert abs(p0[0]-15.35) < 0.02
+    with pytest.raises(ValueError):
+        find_peak_window(x, y, center=25., search=0.1)
+
+    # Narrow windows keep a minimum number of points.
+    _, window = find_peak_window(x, y, width=0.1, min_points=20)
+    assert np.count_nonzero((x >= window[0]) & (x <= window[1])) >= 20
+
+
+@pytest.mark.parametrize('method', PEAK_ESTIMATORS)
+def test_estimate_peak_position(method):
+    x = np.linspace(14.5, 15.5, 201)
+    centers = np.linspace(14.9, 15.1, 7)
+    y = pseudo_voigt(x, centers[:, None], 0.03, 10., 5., 0.3)
+    x0 = estimate_peak_position(x, y, method)
+    assert x0.shape == (7,)
+    np.testing.assert_allclose(x0, centers, atol=2e-3)
+    assert estimate_peak_position(x, y[3], method) == x0[3]
+    # Two points above half of the maximum, with uneven spacing.
+    x = np.array([0., 2.94, 6.05, 8.34, 14.41])
+    x0 = estimate_peak_position(x, [0., 1., 10., 9., 0.], method)
+    if method == 'centroid':
+        assert x0 == pytest.approx((10*x[2]+9*x[3])/19, abs=1e-12)
+    elif method == 'caruana':
+        assert x0 == x[2]
+    else:
+        assert x[2] < x0 < x[3]
+
+
+@pytest.mark.parametrize('method', PEAK_ESTIMATORS)
+def test_estimate_peak_position_two_peaks(method):
+    x = np.linspace(14., 17., 601)
+    # Sample peak at 70% of the height of the calibrant peak.
+    y = pseudo_voigt(x, 15., 0.03, 10., 5., 0.3)+pseudo_voigt(x, 15.2, 0.03, 7., 0., 0.3)
+    assert abs(estimate_peak_position(x, y, method)-15.) < 1e-4
+    x0 = estimate_peak_position(x, np.stack([y, y[::-1]]), method)
+    np.testing.assert_allclose(x0, [15., 16.], atol=1e-4)
+
+
+def test_estimate_peak_position_gaussian():
+    x = np.linspace(-1., 1., 41)
+    y = 5.+100*np.exp(-(x-0.123)**2/2/0.1**2)
+    for method in ['log-parabolic', 'caruana']:
+        assert abs(estimate_peak_position(x, y, method)-0.123) < 1e-2
+    assert abs(estimate_peak_position(x, y, 'caruana')-0.123) < 1e-4
+
+
+def test_estimate_pressure():
+    x = np.linspace(14.5, 15.5, 201)
+    y = pseudo_voigt(x, np.array([[15.0], [15.1]]), 0.03, 10., 5., 0.3)
+    pressure, x0, status = estimate_pressure(x, y, 300., 20., '111', 'Au')
+    assert pressure.shape == (2,)
+    np.testing.assert_allclose(pressure, calculate_pressure(x0, 300., 20., '111', 'Au'))
+    assert pressure[1] > pressure[0]
+    assert list(status) == [0, 0]
+
+    # Each scan has its own status.
+    pressure, x0, status = estimate_pressure(x, y, [300., 600.], 20., '111', 'Au')
+    assert np.isfinite(pressure[0]) and np.isnan(pressure[1])
+    assert [PRESSURE_STATUS[code] for code in status] == ['ok', 'temperature out of range']
+
+    pressure, x0, status = estimate_pressure(x, y[0], 300., 20., '111', 'Au')
+    assert pressure == calculate_pressure(x0, 300., 20., '111', 'Au') and status == 0
+
+
+@pytest.mark.parametrize('shared_lattice', [True, False])
+def test_fit_multi_peak(shared_lattice):
+    rng = np.random.RandomState(4)
+    lattice = 0.97*(4*load_au_params(300.)[0])**(1./3.)
+    reflections = ['111', '200', '220']
+    positions = [reflection_tth(lattice, 20., hkl) for hkl in reflections]
+    x = np.linspace(12., 26., 2801)
+    y = 5.+rng.normal(0, 1., x.size)
+    for x0, sigma, amplitude in zip(positions, [0.03, 0.035, 0.04], [10., 5., 3.]):
+        y += pseudo_voigt(x, x0, sigma, amplitude, 0., 0.4)
+
+    result = fit_multi_peak(x, y, 20., 300., reflections=reflections, shared_lattice=shared_lattice)
+    assert abs(result.lattice-lattice) < 5*result.lattice_error
+    assert result.lattice_error < 1e-4
+    np.testing.assert_allclose(result.popt[:, 0], positions, atol=1e-3)
+    np.testing.assert_allclose(result.popt[:, 2], [10., 5., 3.], rtol=0.05)
+    pressure = calculate_pressure(positions[0], 300., 20., '111', 'Au')
+    assert abs(result.pressure-pressure) < 0.05
+
+    # The 311 reflection is at about 30 deg, outside of the scan.
+    for kwargs in [dict(reflections=['111', '100']), dict(reflections=['111', '311']), dict(calibrant='Pt'),
+                   dict(temperature=700.)]:
+        with pytest.raises(ValueError):
+            fit_multi_peak(x, y, 20., **kwargs)
+
+
+@pytest.mark.parametrize('fit_alpha', [True, False])
+def test_fit_pseudo_voigt_global(peak, fit_alpha):
+    x, _, params = peak
+    rng = np.random.RandomState(5)
+    centers = np.linspace(11.0, 11.4, 6)
+    scans = [pseudo_voigt(x, x0, *params[1:])+rng.normal(0, 1., x.size) for x0 in centers]
+    # Ragged scans.
+    xs = [x[i:] for i in range(6)]
+    ys = [y[i:] for i, y in enumerate(scans)]
+
+    popt = fit_pseudo_voigt_global(xs, ys, fit_alpha=fit_alpha, alpha_guess=0.3)
+    assert popt.shape == (6, 5)
+    assert (popt[:, 1] == popt[0, 1]).all() and (popt[:, 4] == popt[0, 4]).all()
+    np.testing.assert_allclose(popt[:, 0], centers, atol=2e-3)
+    np.testing.assert_allclose(popt[0, [1, 4]], [params[1], params[4]], rtol=0.05)
+
+    pressure, popt_pressure = global_fit_pressure(xs, ys, 300., np.full(6, 20.), fit_alpha=fit_alpha,
+                                                  alpha_guess=0.3)
+    np.testing.assert_allclose(popt_pressure, popt)
+    np.testing.assert_allclose(pressure, [calculate_pressure(x0, 300., 20., '111', 'Au') for x0 in popt[:, 0]])
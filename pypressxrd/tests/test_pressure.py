@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+from scipy.interpolate import interp1d
+
+from pypressxrd import logic
+from pypressxrd.logic import (CALIBRANTS, HOLZAPFEL_PARAMS, PRESSURE_STATUS, PressureGrid, calculate_pressure,
+                              calculate_pressure_array, get_eos, reflection_allowed, reflection_tth,
+                              register_calibrant, tth_from_pressure, unregister_calibrant)
+
+
+@pytest.mark.parametrize('bragg_peak', ['111', '200', '220'])
+def test_calculate_pressure_array(bragg_peak):
+    tth = np.linspace(14., 30., 50)
+    temperature = np.linspace(10., 490., 50)
+    pressure, status = calculate_pressure_array(tth, temperature, 20., bragg_peak, 'Au', tth_off=0.01)
+    assert (status == 0).all()
+    expected = [calculate_pressure(*values, 20., bragg_peak, 'Au', tth_off=0.01)
+                for values in zip(tth, temperature)]
+    np.testing.assert_allclose(pressure, expected, rtol=1e-12)
+
+
+def test_calculate_pressure_array_status():
+    pressure, status = calculate_pressure_array([[15.], [np.nan]], [300., 600.], 20.,
+                                                bragg_peak=['111', '310'], calibrant='Au')
+    assert pressure.shape == status.shape == (2, 2)
+    assert [PRESSURE_STATUS[code] for code in status.ravel()] == ['ok', 'unknown bragg peak', 'invalid input',
+                                                                  'unknown bragg peak']
+    assert np.isfinite(pressure[0, 0]) and np.isnan(pressure.ravel()[1:]).all()
+
+    pressure, status = calculate_pressure_array(15., [300., 600., 300.], [20., -1., 20.],
+                                                calibrant=['Pt', 'Au', 'Ag'])
+    assert list(status) == [1, 3, 0]
+    assert np.isnan(pressure[:2]).all()
+    assert pressure[2] == calculate_pressure(15., 300., 20., '111', 'Ag')
+
+
+@pytest.mark.parametrize('calibrant', ['Au', 'Ag'])
+def test_eos_parameters(calibrant):
+    eos = get_eos(calibrant)
+    assert get_eos(calibrant) is eos
+    params = HOLZAPFEL_PARAMS[calibrant]
+    temperature = np.array([0., 5., 123.4, 300., 500.])
+    expected = [interp1d(params['temperature'], params[key])(temperature) for key in ['v0', 'k0', 'kp0']]
+    np.testing.assert_allclose(eos.parameters(temperature), expected, rtol=1e-12)
+    for i, value in enumerate(temperature):
+        np.testing.assert_allclose(eos.parameters(value), np.array(expected)[:, i], rtol=1e-12)
+        np.testing.assert_allclose(eos.constants(value), [c[i] for c in eos.constants(temperature)], rtol=1e-12)
+    assert np.isnan(eos.parameters([-1., 501.])).all()
+    assert np.isnan(eos.constants(600.)).all()
+
+
+def test_calculate_pressure_temperature_range():
+    assert 'Temperature' in calculate_pressure(15., 600., 20., '111', 'Au')
+    assert '0-500K, but 600.0' in calculate_pressure(np.array([15., 15.1]), [300., 600.], 20., '111', 'Au')
+    pressure = calculate_pressure(np.array([15., 15.1]), np.array([300., 310.]), 20., '111', 'Au')
+    np.testing.assert_allclose(pressure, calculate_pressure_array([15., 15.1], [300., 310.], 20.)[0])
+
+
+@pytest.mark.parametrize('form', ['AP2', 'Vinet', 'BM3'])
+def test_register_calibrant(form):
+    register_calibrant('Test', 'bcc', [0., 1000.], [10., 11.], [100., 90.], [4., 5.], form=form, z=40)
+    try:
+        eos = get_eos('Test')
+        lattice = eos.lattice_parameter(500.)
+        np.testing.assert_allclose(lattice, (2*10.5)**(1./3.))
+        # Zero pressure at V0, and K0 for small compressions.
+        assert abs(eos.lattice_pressure(lattice, 500.)) < 0.01
+        strain = 1e-4
+        np.testing.assert_allclose(eos.pressure(10.5*(1-strain), 500.), 95.*strain, rtol=0.01)
+        assert (np.diff(eos.pressure(np.linspace(6., 10., 5), 500.)) < 0).all()
+
+        assert 'bragg peak' in calculate_pressure(15., 300., 20., '111', 'Test')
+        tth = reflection_tth(0.99*lattice, 20., '110')
+        pressure, status = calculate_pressure_array(tth, 500., 20., ['110', '111'], 'Test')
+        assert list(status) == [0, 2]
+        assert pressure[0] == calculate_pressure(tth, 500., 20., '110', 'Test') > 0
+    finally:
+        unregister_calibrant('Test')
+    assert 'Test' not in CALIBRANTS and 'Test' not in logic._EOS
+
+
+def test_register_calibrant_errors():
+    with pytest.raises(ValueError):
+        register_calibrant('Test', 'hcp', [0., 1.], [1., 1.], [1., 1.], [4., 4.], form='BM3')
+    with pytest.raises(ValueError):
+        register_calibrant('Test', 'fcc', [0., 1.], [1., 1.], [1., 1.], [4., 4.], form='AP2')
+    with pytest.raises(ValueError):
+        register_calibrant('Test', 'fcc', [0., 1.], [1.], [1., 1.], [4., 4.], form='BM3')
+    assert 'Test' not in CALIBRANTS
+    assert 'calibrant' in calculate_pressure(15., 300., 20., '111', 'Test')
+
+
+def test_reflection_allowed():
+    hkls = ['111', '200', '220', '311', '100', '210']
+    assert [reflection_allowed('fcc', hkl) for hkl in hkls] == [True]*4+[False]*2
+    assert [reflection_allowed('bcc', hkl) for hkl in ['110', '200', '211', '111']] == [True]*3+[False]
+    assert reflection_allowed('sc', '100') and not reflection_allowed('sc', '000')
+
+
+def test_pressure_grid():
+    grid = PressureGrid(tolerance=1e-2)
+    rng = np.random.RandomState(0)
+    grid.build()
+    assert grid.error_bound <= 1e-2
+    tth = rng.uniform(grid.tth[0], grid.tth[-1], 1000)
+    temperature = rng.uniform(0., 500., 1000)
+    exact, _ = calculate_pressure_array(tth, temperature, 20.)
+    pressure = grid.pressure(tth, temperature)
+    assert np.abs(pressure-exact).max() <= grid.error_bound
+    np.testing.assert_allclose([grid.pressure(*values) for values in zip(tth[:5], temperature[:5])], pressure[:5],
+                               rtol=1e-12)
+    assert np.isnan(grid.pressure([grid.tth[0]-0.1, 15.5], [300., 600.])).all()
+    np.testing.assert_allclose(grid.pressure(tth+0.01, 300., tth_off=0.01), grid.pressure(tth, 300.))
+
+    # The grid is rebuilt on the next lookup after a change.
+    table = grid.table
+    grid.update(energy=25., calibrant='Ag', temperature_range=(100., 400.))
+    assert grid.table is table
+    tth = reflection_tth(4.05, 25., '111')
+    np.testing.assert_allclose(grid.pressure(tth, 295.), calculate_pressure(tth, 295., 25., '111', 'Ag'),
+                               atol=grid.error_bound)
+    assert grid.table is not table
+    assert grid.temperature[0] == 100. and grid.temperature[-1] == 400.
+    with pytest.raises(TypeError):
+        grid.update(hkl='200')
+
+
+@pytest.mark.parametrize('calibrant, bragg_peak', [('Au', '111'), ('Au', '220'), ('Ag', '200')])
+def test_tth_from_pressure(calibrant, bragg_peak):
+    pressure = np.linspace(-5., 300., 50)
+    temperature = np.linspace(10., 490., 50)[:, None]
+    tth = tth_from_pressure(pressure, temperature, 20., bragg_peak, calibrant, tth_off=0.02)
+    assert tth.shape == (50, 50)
+    result, status = calculate_pressure_array(tth, temperature, 20., bragg_peak, calibrant, tth_off=0.02)
+    assert (status == 0).all()
+    np.testing.assert_allclose(result, np.broadcast_to(pressure, tth.shape), atol=1e-9)
+    assert np.isnan(tth_from_pressure(10., 600., 20., bragg_peak, calibrant))
+    with pytest.raises(ValueError):
+        tth_from_pressure(10., 300., 20., '100', calibrant)
+
+
+@pytest.mark.parametrize('form', ['AP2', 'Vinet', 'BM3'])
+def test_eos_volume(form):
+    register_calibrant('Test', 'fcc', [0., 1000.], [10., 11.], [100., 90.], [4.5, 5.], form=form, z=40)
+    try:
+        eos = get_eos('Test')
+        pressure = np.linspace(-10., 500., 20)
+        np.testing.assert_allclose(eos.pressure(eos.volume(pressure, 300.), 300.), pressure, atol=1e-9)
+        assert np.isnan(eos.volume(10., 2000.))
+    finally:
+        unregister_calibrant('Test')
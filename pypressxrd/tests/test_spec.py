@@ -0,0 +1,196 @@
+import os
+
+import numpy as np
+
+from pypressxrd.logic import (ScanCache, SpecFile, SpecIndexCache, fit_spec_file, index_spec_file, load_scan,
+                              read_metadata)
+from pypressxrd.tests.conftest import HEADER, make_scan
+
+
+def test_spec_file_reads_scans(spec_fname):
+    spec = SpecFile(spec_fname)
+    assert spec.getScanNumbers() == ['1', '2', '3']
+    assert spec.getScanCommands([2])[0].startswith('#S 2 ascan')
+    x, y, temperature, energy = load_scan(spec, 2, 'tth', 'Detector')
+    assert len(x) == len(y) == 41
+    assert temperature == {'Control': 300.0, 'Sample': 299.5}
+    assert energy == 20.0
+
+
+def test_spec_file_update_reads_only_new_scans(spec_fname):
+    spec = SpecFile(spec_fname)
+    offset = spec.offset
+
+    text = make_scan(4)
+    with open(spec_fname, 'a') as f:
+        # Scan 4 is still being written.
+        f.write(text[:len(text)//2])
+    assert spec.update() == ['3', '4']
+    assert spec.offset > offset
+    npts = len(spec.getScan(4).data['tth'])
+    assert 0 < npts < 41
+
+    with open(spec_fname, 'a') as f:
+        f.write(text[len(text)//2:]+make_scan(5))
+    assert spec.update() == ['4', '5']
+    assert len(spec.getScan(4).data['tth']) == 41
+    assert spec.getScanNumbers() == ['1', '2', '3', '4', '5']
+    assert spec.update() == []
+
+
+def test_spec_file_update_rereads_overwritten_file(spec_fname):
+    spec = SpecFile(spec_fname)
+    with open(spec_fname, 'w') as f:
+        f.write(make_scan(1))
+    assert spec.update() == ['1']
+    assert len(spec) == 1
+
+
+def test_index_spec_file_across_chunks(spec_fname):
+    index = index_spec_file(spec_fname)
+    assert [line.split()[1] for _, line in index] == ['1', '2', '3']
+    # Small chunks split the #S markers between reads.
+    assert index_spec_file(spec_fname, chunk_size=5) == index
+    with open(spec_fname, 'rb') as f:
+        content = f.read()
+    for offset, line in index:
+        assert content[offset:].startswith(line.encode())
+
+
+def test_spec_file_parses_scans_on_demand(spec_fname):
+    spec = SpecFile(spec_fname)
+    assert len(spec._parsed) == 0
+    assert spec.getScan(2).L == ['tth', 'Seconds', 'Monitor', 'Detector']
+    assert list(spec._parsed) == ['2']
+    assert spec.getScan(7) is None
+
+
+def test_spec_index_cache(spec_fname, tmp_path):
+    cache = SpecIndexCache(str(tmp_path / 'cache'))
+    spec = SpecFile(spec_fname, cache=cache)
+    spec.get_metadata(2)
+    # The metadata is saved in batches or when the file is closed.
+    assert cache.load(spec_fname)['metadata'] == {}
+    spec.close()
+
+    state = cache.load(spec_fname)
+    assert [entry[0] for entry in state['index']] == ['1', '2', '3']
+    assert state['metadata']['2'][:2] == [{'Control': 300.0, 'Sample': 299.5}, 20.0]
+
+    # Only the appended scans are indexed when the file grew.
+    with open(spec_fname, 'a') as f:
+        f.write(make_scan(4))
+    spec = SpecFile(spec_fname, cache=cache)
+    assert spec.getScanNumbers() == ['1', '2', '3', '4']
+    assert '2' in spec.metadata
+
+    # A file with a different beginning is indexed again.
+    with open(spec_fname, 'w') as f:
+        f.write(make_scan(8)+make_scan(9)+make_scan(10)+make_scan(11)+make_scan(12))
+    assert cache.load(spec_fname) is None
+
+
+def test_spec_index_cache_eviction(spec_fname, tmp_path):
+    cache = SpecIndexCache(str(tmp_path / 'cache'), max_bytes=0)
+    SpecFile(spec_fname, cache=cache)
+    assert os.listdir(cache.path) == []
+
+
+def test_read_data_matches_parsed_scan(spec_fname):
+    spec = SpecFile(spec_fname)
+    labels, data = spec.read_data(2)
+    scan = spec.getScan(2)
+    assert labels == scan.L
+    assert data.shape == (41, 4)
+    assert data.dtype == np.float64
+    np.testing.assert_array_equal(data[:, 3], scan.data['Detector'])
+
+
+def test_read_data_skips_incomplete_rows(spec_fname):
+    text = make_scan(4)
+    with open(spec_fname, 'a') as f:
+        f.write(text[:text.index('\n', len(text)//2)+6])
+    spec = SpecFile(spec_fname)
+    labels, data = spec.read_data(4)
+    assert 0 < data.shape[0] < 41
+    assert len(spec.getScan(4).data['tth']) == data.shape[0]
+
+
+def test_read_metadata_stops_at_data():
+    text = make_scan(1, temperature=10.0)
+    # Lines after the first data row are not read.
+    text += '#X Control: 500.0K\n'
+    metadata = read_metadata(text)
+    assert metadata.temperature == {'Control': 10.0, 'Sample': 9.5}
+    assert metadata.energy == 20.0
+    assert metadata.date == 'Wed Sep 26 12:01:00 2018'
+    assert metadata.count_time == 1.0
+    assert metadata.count_mode == 'time'
+    assert read_metadata('#S 1 ascan\n').energy is None
+
+
+def test_load_scan_selected_columns(spec_fname):
+    spec = SpecFile(spec_fname)
+    labels, data = spec.read_data(1, columns=['Detector', 'tth'])
+    assert labels == ['Detector', 'tth']
+    assert data.shape == (41, 2)
+
+    x, y, _, _ = load_scan(spec, 1, 'tth', 'Detector', norm_column='Monitor', dtype=np.float32)
+    assert x.dtype == y.dtype == np.float32
+    assert x.flags['C_CONTIGUOUS'] and y.flags['C_CONTIGUOUS']
+    np.testing.assert_allclose(y, spec.getScan(1).data['Detector']/1000., rtol=1e-6)
+
+
+def test_scan_cache(spec_fname):
+    spec = SpecFile(spec_fname)
+    cache = ScanCache(max_scans=2)
+    x, y, temperature, energy = cache.load_scan(spec, 1, 'tth', 'Detector')
+    np.testing.assert_array_equal(y, load_scan(spec, 1, 'tth', 'Detector')[1])
+    assert cache.get(spec, 1) is cache.get(spec, 1)
+
+    cache.get(spec, 2)
+    cache.get(spec, 1)
+    cache.get(spec, 3)
+    # Scan 2 was the least recently used.
+    assert spec.scan_id(2) not in cache
+    assert spec.scan_id(1) in cache and len(cache) == 2
+
+    cache = ScanCache(max_bytes=cache.get(spec, 1).data.nbytes)
+    cache.get(spec, 1)
+    cache.get(spec, 2)
+    assert len(cache) == 1 and spec.scan_id(2) in cache
+
+
+def test_fit_spec_file(spec_fname):
+    table = fit_spec_file(spec_fname, None, 'tth', 'Detector', workers=2, chunksize=2)
+    assert list(table['scan']) == ['1', '2', '3']
+    assert table['fitted'].all()
+    np.testing.assert_allclose(table['x0'], [11.1, 11.2, 11.3], atol=1e-6)
+    assert (table['temperature'] == 299.5).all()
+    assert np.isfinite(table['pressure']).all()
+    # The index of an open file is reused.
+    state = SpecFile(spec_fname).get_state()
+    serial = fit_spec_file(spec_fname, [3, 1], 'tth', 'Detector', state=state, workers=1)
+    assert list(serial['scan']) == ['3', '1']
+    np.testing.assert_allclose(serial['pressure'], table['pressure'][[2, 0]])
+    warm = fit_spec_file(spec_fname, None, 'tth', 'Detector', warm_start=True, workers=1)
+    np.testing.assert_allclose(warm['x0'], table['x0'], atol=1e-6)
+    cropped = fit_spec_file(spec_fname, None, 'tth', 'Detector', window=4., workers=1)
+    np.testing.assert_allclose(cropped['x0'], table['x0'], atol=1e-4)
+    assert (cropped['window_max']-cropped['window_min'] < table['window_max']-table['window_min']).all()
+
+
+def test_fit_spec_file_expected_pressure(tmp_path):
+    fname = str(tmp_path / 'pressure.spec')
+    with open(fname, 'w') as f:
+        f.write(HEADER+''.join(make_scan(i, x0=15.1+0.05*i) for i in range(1, 4)))
+    table = fit_spec_file(fname, None, 'tth', 'Detector', workers=1)
+    expected = fit_spec_file(fname, None, 'tth', 'Detector', window=4., expected_pressure=table['pressure'][1],
+                             search=0.2, workers=1)
+    np.testing.assert_allclose(expected['x0'], table['x0'], atol=1e-4)
+
+    # The peak at 100 GPa is outside of the scans.
+    missed = fit_spec_file(fname, None, 'tth', 'Detector', window=4., expected_pressure=100., search=0.2,
+                           workers=1)
+    assert not missed['fitted'].any()
+    assert np.isnan(missed['window_min']).all() and np.isnan(missed['window_max']).all()
@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtCore = pytest.importorskip('PyQt5.QtCore')
+
+from pypressxrd.watcher import FileWatcher  # noqa: E402
+from pypressxrd.workers import TaskQueue  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+def run_events(app, seconds, until=None):
+    end = time.time()+seconds
+    while time.time() < end:
+        app.processEvents()
+        if until is not None and until():
+            return
+        time.sleep(0.005)
+
+
+def test_file_watcher_debounces_bursts(app, tmp_path):
+    fname = str(tmp_path / 'test.spec')
+    with open(fname, 'w') as f:
+        f.write('#F test.spec\n')
+    watcher = FileWatcher(debounce=0.1, min_interval=0.2, poll_interval=0.02)
+    signals = []
+    watcher.changed.connect(signals.append)
+    watcher.watch(fname)
+
+    for i in range(5):
+        with open(fname, 'a') as f:
+            f.write('line {:d}\n'.format(i))
+        run_events(app, 0.02)
+    run_events(app, 0.5)
+    assert signals == [fname]
+    watcher.stop()
+
+
+def test_file_watcher_limits_the_rate(app, tmp_path):
+    fname = str(tmp_path / 'test.spec')
+    with open(fname, 'w') as f:
+        f.write('#F test.spec\n')
+    watcher = FileWatcher(debounce=0.1, min_interval=0.3, poll_interval=0.02)
+    times = []
+    watcher.changed.connect(lambda fname: times.append(time.time()))
+    watcher.watch(fname)
+
+    # Writes every 20 ms never leave the debounce time without changes.
+    start = time.time()
+    while time.time()-start < 1.5:
+        with open(fname, 'a') as f:
+            f.write('line\n')
+        run_events(app, 0.02)
+    watcher.stop()
+    assert 2 <= len(times) <= 1.5/0.3+1
+    assert all(b-a >= 0.3-0.02 for a, b in zip(times, times[1:]))
+
+
+def test_task_queue_drops_superseded_tasks(app):
+    queue = TaskQueue()
+    busy = []
+    queue.busy.connect(busy.append)
+    finished = []
+    queue.submit('scan', time.sleep, 0.1, on_finished=lambda result: finished.append('first'))
+    queue.submit('scan', lambda: 'second', on_finished=finished.append)
+    run_events(app, 2., until=lambda: busy[-1:] == [False])
+    assert finished == ['second']
+    assert busy == [True, False]
+
+
+def test_task_queue_cancel_and_errors(app):
+    queue = TaskQueue()
+    results = []
+    queue.submit('scan', time.sleep, 0.1, on_finished=results.append)
+    queue.cancel('scan')
+    assert not queue.is_busy()
+    queue.submit('other', lambda: 1/0, on_error=lambda error: results.append(type(error)))
+    run_events(app, 0.5)
+    queue.pool.waitForDone()
+    run_events(app, 0.1)
+    assert results == [ZeroDivisionError]
+    assert not queue.is_busy()
+
+    # Background tasks do not make the queue busy.
+    queue.submit('prefetch', lambda: None, background=True)
+    assert not queue.is_busy()
+    queue.pool.waitForDone()
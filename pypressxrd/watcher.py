@@ -0,0 +1,118 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+'''
+
+import os
+import time
+
+from PyQt5.QtCore import QObject,QTimer,QFileSystemWatcher,pyqtSignal
+
+
+class FileWatcher(QObject):
+    """Watches a file and emits changed when it is modified.
+
+    QFileSystemWatcher (inotify on Linux) reports the changes when possible. The
+    file size and mtime are also polled, since file system events are not delivered
+    for some files (e.g. written by another machine on a network file system). The
+    polling is faster when QFileSystemWatcher cannot watch the file.
+
+    Changes are debounced, so a burst of writes gives a single signal, and signals
+    are at least min_interval apart.
+
+    Parameters
+    -----------
+    debounce: float (Optional)
+        Time in seconds without changes before the signal is emitted.
+
+    min_interval: float (Optional)
+        Minimum time in seconds between two signals.
+
+    poll_interval: float (Optional)
+        Time in seconds between checks of the file, if it cannot be watched.
+
+    Signals
+    -----------
+    changed: string
+        Path of the file.
+    """
+
+    changed = pyqtSignal(str)
+
+    def __init__(self,debounce=0.3,min_interval=2.0,poll_interval=1.0):
+
+        super(FileWatcher,self).__init__()
+
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.poll_interval = poll_interval
+
+        self.fname = None
+        self._stat = None
+        self._last_emit = 0.
+        self._first_change = 0.
+
+        self._watcher = QFileSystemWatcher()
+        self._watcher.fileChanged.connect(self.file_changed)
+
+        self._poll_timer = QTimer()
+        self._poll_timer.timeout.connect(self.poll)
+
+        self._emit_timer = QTimer()
+        self._emit_timer.setSingleShot(True)
+        self._emit_timer.timeout.connect(self.emit_changed)
+
+    def watch(self,fname):
+        """Starts watching fname, replacing the previous file."""
+
+        self.stop()
+        self.fname = fname
+        self._stat = self.get_stat()
+        if self._watcher.addPath(fname):
+            self._poll_timer.start(int(10000*self.poll_interval))
+        else:
+            self._poll_timer.start(int(1000*self.poll_interval))
+
+    def stop(self):
+        """Stops watching the file."""
+
+        if self._watcher.files():
+            self._watcher.removePaths(self._watcher.files())
+        self._poll_timer.stop()
+        self._emit_timer.stop()
+        self.fname = None
+
+    def get_stat(self):
+        try:
+            stat = os.stat(self.fname)
+            return stat.st_size,stat.st_mtime
+        except OSError:
+            return None
+
+    def file_changed(self,fname):
+        # Files replaced by a new one (e.g. renamed over) are no longer watched.
+        if fname not in self._watcher.files() and os.path.exists(fname):
+            self._watcher.addPath(fname)
+        self.poll()
+
+    def poll(self):
+        stat = self.get_stat()
+        if stat == self._stat:
+            return
+        self._stat = stat
+
+        now = time.time()
+        if not self._emit_timer.isActive():
+            self._first_change = now
+        # Restarting the timer debounces bursts of writes, but a file that is written
+        # continuously still gives a signal every min_interval.
+        earliest = self._last_emit+self.min_interval
+        when = max(now+self.debounce,earliest)
+        when = min(when,max(self._first_change+self.min_interval,earliest))
+        self._emit_timer.start(int(1000*max(when-now,0)))
+
+    def emit_changed(self):
+        if self.fname is None:
+            return
+        self._last_emit = time.time()
+        self.changed.emit(self.fname)
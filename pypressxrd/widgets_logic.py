@@ -3,18 +3,71 @@
  See LICENSE file.
 '''
 
-from PyQt5.QtWidgets import QFileDialog,QApplication
+from PyQt5.QtWidgets import QFileDialog,QApplication,QProgressBar
 from PyQt5.QtCore import QObject
 
-from spec2nexus.spec import SpecDataFile
+from collections import OrderedDict
 
-from pypressxrd.logic import load_scan,plot_data,fit_pseudo_voigt,pseudo_voigt
-from pypressxrd.logic import calculate_pressure
+from pypressxrd.logic import SpecFile,SpecIndexCache,ScanCache,plot_data,fit_pseudo_voigt,pseudo_voigt
+from pypressxrd.logic import calculate_pressure,fit_spec_file,save_fit_table
+from pypressxrd.workers import TaskQueue
+from pypressxrd.watcher import FileWatcher
 
 from numpy import abs as np_abs
 
 import time
 
+# The functions below run in the TaskQueue thread. They return everything the GUI
+# needs, so that the GUI thread does not read the spec file while it is updated.
+
+def open_spec_file(fname,cache,previous=None,progress=None):
+    if previous is not None:
+        previous.close()
+    spec_file = SpecFile(fname,cache=cache,progress=progress)
+    return spec_file,0,spec_file.getScanCommands()
+
+def update_spec_file(spec_file,progress=None):
+    updated = spec_file.update(progress=progress)
+    # The updated scans are always the last ones in the file.
+    return spec_file,len(spec_file)-len(updated),spec_file.getScanCommands(updated)
+
+def get_spec_state(spec_file):
+    return spec_file.get_state()
+
+def read_scan(spec_file,cache,scan_number,x_label=None,y_label=None):
+    labels = None
+    if x_label is None:
+        labels = cache.get(spec_file,scan_number).labels
+        x_label,y_label = labels[0],labels[-1]
+    x,y,temperature,energy = cache.load_scan(spec_file,scan_number,x_label,y_label)
+    return scan_number,spec_file.scan_id(scan_number),labels,x_label,y_label,x,y,temperature,energy
+
+def initial_parameters(x,y,alpha):
+    # Initial guess shown in the fit boxes for a new scan, rounded as it is shown,
+    # so that a prefetched fit is the same as the one from the Fit button.
+    p0 = [(x.max()+x.min())/2.,np_abs((x.max()-x.min())/6.),y.max(),(y[:5].mean()+y[-5:].mean())/2.]
+    return [float('{:.3f}'.format(value)) for value in p0]+[alpha]
+
+def prefetch_scans(spec_file,cache,scan_numbers,x_label,y_label,known,fit_alpha,alpha_guess,progress=None):
+    # Loads the scans into the cache and returns the fits that are not in known.
+    fits = []
+    for i,scan_number in enumerate(scan_numbers):
+        progress(float(i)/len(scan_numbers))
+        try:
+            x,y,_,_ = cache.load_scan(spec_file,scan_number,x_label,y_label)
+        except (KeyError,ValueError,IndexError):
+            continue
+        key = (spec_file.scan_id(scan_number),x_label,y_label,fit_alpha,alpha_guess)
+        if key in known:
+            continue
+        try:
+            popt = fit_pseudo_voigt(x,y,p0=initial_parameters(x,y,alpha_guess),fit_alpha=fit_alpha,
+                                    alpha_guess=alpha_guess)
+        except (RuntimeError,ValueError,TypeError):
+            popt = None
+        fits.append((key,popt))
+    return fits
+
 class LogicWidgets(QObject):
     def __init__(self,status,options,plot):
         
@@ -34,6 +87,24 @@ class LogicWidgets(QObject):
         self.fit_line = []
         self.axv_line = None
         self.spec_fname = ''
+        self._spec_file = None
+        self._index_cache = SpecIndexCache()
+        self._scan_cache = ScanCache()
+        self._prefits = OrderedDict()
+        self.max_prefits = 100
+        self.prefetch_count = 2
+        
+        self.watcher = FileWatcher()
+        self._follow_pending = False
+        self._follow_dirty = False
+        
+        self.tasks = TaskQueue()
+        # Fitting all the scans takes long, so it does not block loading scans.
+        self.fit_tasks = TaskQueue()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(150)
+        self.progress_bar.hide()
+        self.status.addPermanentWidget(self.progress_bar)
         
         self.make_connections()
 
@@ -41,7 +112,9 @@ class LogicWidgets(QObject):
         
         self.spec.load_button.clicked.connect(self.get_spec_fname)
         self.spec.load_button.clicked.connect(self.load_spec_file)
-        self.spec.reload_button.clicked.connect(self.load_spec_file)
+        self.spec.reload_button.clicked.connect(self.reload_spec_file)
+        self.spec.follow_box.toggled.connect(self.follow_file)
+        self.watcher.changed.connect(self.follow_update)
         
         self.scan.scans_box.activated[str].connect(self.selected_scan)
         
@@ -61,6 +134,13 @@ class LogicWidgets(QObject):
         self.pressure.ag.toggled.connect(self.ag_selected)
         
         self.pressure.pressure_button.clicked.connect(self.pressure_calculator)
+        self.pressure.fit_all_button.clicked.connect(self.fit_all_scans)
+        
+        self.tasks.busy.connect(self.show_progress)
+        self.tasks.busy.connect(self.follow_idle)
+        self.tasks.progress.connect(self.update_progress)
+        self.fit_tasks.busy.connect(self.show_progress)
+        self.fit_tasks.progress.connect(self.update_progress)
      
     def get_spec_fname(self):
         
@@ -69,53 +149,105 @@ class LogicWidgets(QObject):
             self.spec_fname, _ = QFileDialog.getOpenFileName(self.spec,"QFileDialog.getOpenFileName()", "","All Files (*);;Spec Files (*.spec)", options=options)
             self.spec.fname.setText('{}'.format(self.spec_fname.split('/')[-1]))
      
+    def show_progress(self,busy):
+        # Busy indicator until a task reports its progress.
+        self.progress_bar.setRange(0,0)
+        self.progress_bar.setVisible(self.tasks.is_busy() or self.fit_tasks.is_busy())
+        
+    def update_progress(self,fraction):
+        self.progress_bar.setRange(0,100)
+        self.progress_bar.setValue(int(100*fraction))
+     
     def load_spec_file(self):
         
         if self.spec_fname == '':
             self.status.showMessage('No file was loaded')
             return
         
+        self.tasks.cancel('scan')
+        self.tasks.cancel('prefetch')
+        self._prefits.clear()
+        if self.spec.follow_box.isChecked():
+            self.watcher.watch(self.spec_fname)
         self.scan.scans_box.clear()
-        try:
-            self._spec_file = SpecDataFile(self.spec_fname)
-            
-            self._commands_list = self._spec_file.getScanCommands()
-            for i in range(len(self._commands_list)):
-                if '#S' in self._commands_list[i]:
-                    self._commands_list[i] = self._commands_list[i].strip('#S ')
-                self.scan.scans_box.addItem(self._commands_list[i])
-                
-            self.scan.scans_box.setCurrentIndex(len(self._commands_list)-1)
-            
-            self.selected_scan(self._commands_list[-1])
-            self.make_plot()
+        self.status.showMessage('Loading {}...'.format(self.spec.fname.text()))
+        self.tasks.submit('spec',open_spec_file,self.spec_fname,self._index_cache,self._spec_file,
+                          on_finished=self.spec_file_loaded,on_error=self.spec_file_failed,
+                          report_progress=True)
+
+    def reload_spec_file(self):
+        
+        if self._spec_file is None or self._spec_file.fname != self.spec_fname:
+            self.load_spec_file()
+            return
+        
+        self.tasks.submit('spec',update_spec_file,self._spec_file,
+                          on_finished=self.spec_file_loaded,on_error=self.spec_file_failed,
+                          report_progress=True)
+        
+    def spec_file_loaded(self,result):
+        
+        self._spec_file,first,commands = result
+        
+        if len(commands) == 0:
+            self.follow_done()
+            if first == 0:
+                self.status.showMessage('No scans in {}'.format(self.spec.fname.text()))
+            else:
+                self.status.showMessage('No new scans')
+            return
+        
+        while self.scan.scans_box.count() > first:
+            self.scan.scans_box.removeItem(first)
+        if first == 0:
             self.pressure.print_pressure.setText('')
-        except:
+        self.add_scans(commands)
+        
+    def spec_file_failed(self,error):
+        self.follow_done()
+        if self._spec_file is not None and self._spec_file.fname == self.spec_fname:
+            self.status.showMessage('Could not read {}!!'.format(self.spec.fname.text()))
+        else:
             self.status.showMessage('{} is not a spec file!!'.format(self.spec.fname.text()))
-
+        
+    def add_scans(self,commands):
+        
+        for i in range(len(commands)):
+            if '#S' in commands[i]:
+                commands[i] = commands[i].strip('#S ')
+            self.scan.scans_box.addItem(commands[i])
+            
+        self.scan.scans_box.setCurrentIndex(self.scan.scans_box.count()-1)
+        self.selected_scan(commands[-1])
   
     def selected_scan(self,text):
         self._scan_number = int(text.split()[0])
-        self._columns = self._spec_file.getScan(self._scan_number).L
-        firstcol = self._spec_file.getScan(self._scan_number).column_first
-        lastcol = self._spec_file.getScan(self._scan_number).column_last
-    
-        self.scan.x_box.clear()
-        self.scan.x_box.addItems(self._columns)
-        self.scan.x_box.setCurrentText(firstcol)
-        
-        self.scan.y_box.clear()
-        self.scan.y_box.addItems(self._columns)
-        self.scan.y_box.setCurrentText(lastcol)
-    
-        self.load_scan_wrap()
+        self.tasks.cancel('prefetch')
+        self.tasks.submit('scan',read_scan,self._spec_file,self._scan_cache,self._scan_number,
+                          on_finished=self.scan_loaded,on_error=self.scan_failed)
         
     def load_scan_wrap(self):
+        self.tasks.cancel('prefetch')
+        self.tasks.submit('scan',read_scan,self._spec_file,self._scan_cache,self._scan_number,
+                          self.scan.x_box.currentText(),self.scan.y_box.currentText(),
+                          on_finished=self.scan_loaded,on_error=self.scan_failed)
+        
+    def scan_loaded(self,result):
+        scan_number,scan_id,columns,xcol,ycol,x,y,temperature,energy = result
+        
+        if columns is not None:
+            self._columns = columns
+        
+            self.scan.x_box.clear()
+            self.scan.x_box.addItems(self._columns)
+            self.scan.x_box.setCurrentText(xcol)
+            
+            self.scan.y_box.clear()
+            self.scan.y_box.addItems(self._columns)
+            self.scan.y_box.setCurrentText(ycol)
+        
         try:
-            self.x,self.y,self.temperature,self.energy = load_scan(self._spec_file,
-                                                                   self._scan_number,
-                                                                   self.scan.x_box.currentText(),
-                                                                   self.scan.y_box.currentText())
+            self.x,self.y,self.temperature,self.energy = x,y,temperature,energy
             
             self.scan.energy_read.setText('{:0.4f}'.format(self.energy))
             
@@ -130,9 +262,83 @@ class LogicWidgets(QObject):
             self.fit_line = []
             self.axv_line = None
             self.update_params()
-            self.status.showMessage('Loaded scan #{:d}'.format(self._scan_number))
+            self.status.showMessage('Loaded scan #{:d}'.format(scan_number))
         except:
-            self.status.showMessage('Could not load scan #{:d}!!'.format(self._scan_number))
+            self.scan_failed(None)
+            return
+        
+        alpha_guess = self.read_alpha()
+        popt = self._prefits.get((scan_id,xcol,ycol,self.fit_alpha,alpha_guess))
+        if popt is not None:
+            self.popt = popt
+            self.yfit = pseudo_voigt(self.x,*self.popt)
+            self.update_params()
+            self.plot_fit()
+        
+        if self._follow_pending:
+            self.fit_data()
+            if self.popt is not None:
+                self.pressure_calculator()
+            self.follow_done()
+        
+        if alpha_guess is not None:
+            self.prefetch_neighbours(xcol,ycol,alpha_guess)
+            
+    def follow_file(self,checked):
+        if checked and self.spec_fname != '':
+            self.watcher.watch(self.spec_fname)
+        else:
+            self.watcher.stop()
+            self._follow_dirty = False
+            
+    def follow_update(self,fname):
+        if fname != self.spec_fname:
+            return
+        # The watcher does not signal this change again, so the file is read again
+        # once the current refresh is done.
+        if self._follow_pending:
+            self._follow_dirty = True
+            return
+        self._follow_pending = True
+        self.reload_spec_file()
+        
+    def follow_done(self):
+        self._follow_pending = False
+        if self._follow_dirty:
+            self._follow_dirty = False
+            self.follow_update(self.spec_fname)
+            
+    def follow_idle(self,busy):
+        # The refresh ended without reaching its callbacks (e.g. it was cancelled).
+        if not busy and self._follow_pending:
+            self.follow_done()
+            
+    def prefetch_neighbours(self,xcol,ycol,alpha_guess):
+        
+        # Closest scans first, alternating forward and back.
+        current = self.scan.scans_box.currentIndex()
+        indexes = []
+        for i in range(1,self.prefetch_count+1):
+            indexes += [current+i,current-i]
+        scan_numbers = [int(self.scan.scans_box.itemText(i).split()[0]) for i in indexes
+                        if 0 <= i < self.scan.scans_box.count()]
+        
+        if len(scan_numbers) > 0:
+            self.tasks.submit('prefetch',prefetch_scans,self._spec_file,self._scan_cache,scan_numbers,
+                              xcol,ycol,frozenset(self._prefits),self.fit_alpha,alpha_guess,
+                              on_finished=self.store_prefits,report_progress=True,background=True)
+            
+    def store_prefits(self,fits):
+        # Least recently added fits are dropped, as in ScanCache.
+        for key,popt in fits:
+            self._prefits[key] = popt
+            self._prefits.move_to_end(key)
+        while len(self._prefits) > self.max_prefits:
+            self._prefits.popitem(last=False)
+            
+    def scan_failed(self,error):
+        self.follow_done()
+        self.status.showMessage('Could not load scan #{:d}!!'.format(self._scan_number))
     
     def update_temp(self,text):
         self.scan.temp_read.setText('{:0.2f}'.format(self.temperature[text]))    
@@ -144,10 +350,11 @@ class LogicWidgets(QObject):
     
     def update_params(self):
         if self.popt is None:
-            self.fit.tth_value.setText('{:.3f}'.format((self.x.max()+self.x.min())/2.))
-            self.fit.amplitude_value.setText('{:.3f}'.format(self.y.max()))
-            self.fit.sigma_value.setText('{:.3f}'.format(np_abs((self.x.max()-self.x.min())/6.)))
-            self.fit.constant_value.setText('{:.3f}'.format((self.y[:5].mean()+self.y[-5:].mean())/2.))
+            p0 = initial_parameters(self.x,self.y,None)
+            self.fit.tth_value.setText('{:.3f}'.format(p0[0]))
+            self.fit.sigma_value.setText('{:.3f}'.format(p0[1]))
+            self.fit.amplitude_value.setText('{:.3f}'.format(p0[2]))
+            self.fit.constant_value.setText('{:.3f}'.format(p0[3]))
         else:
             self.fit.tth_value.setText('{:.3f}'.format(self.popt[0]))
             self.fit.sigma_value.setText('{:.3f}'.format(self.popt[1]))
@@ -171,12 +378,27 @@ class LogicWidgets(QObject):
         self.fit.alpha_value.setDisabled(True)
         self.fit_alpha = False
         
+    def read_alpha(self):
+        # Returns None, with a message, if the alpha box is not a number.
+        try:
+            return float(self.fit.alpha_value.toPlainText())
+        except ValueError:
+            self.status.showMessage('Alpha must be a number!!')
+            return None
+        
     def fit_data(self):
-        p0 = [float(self.fit.tth_value.toPlainText()),
-              float(self.fit.sigma_value.toPlainText()),
-              float(self.fit.amplitude_value.toPlainText()),
-              float(self.fit.constant_value.toPlainText()),
-              float(self.fit.alpha_value.toPlainText())]
+        try:
+            p0 = [float(self.fit.tth_value.toPlainText()),
+                  float(self.fit.sigma_value.toPlainText()),
+                  float(self.fit.amplitude_value.toPlainText()),
+                  float(self.fit.constant_value.toPlainText())]
+        except ValueError:
+            self.status.showMessage('The fit parameters must be numbers!!')
+            return
+        alpha_guess = self.read_alpha()
+        if alpha_guess is None:
+            return
+        p0.append(alpha_guess)
         
         try:
             self.popt = fit_pseudo_voigt(self.x,self.y,p0=p0,fit_alpha=self.fit_alpha,
@@ -193,7 +415,7 @@ class LogicWidgets(QObject):
     def plot_fit(self):
 
         for line in self.fit_line:
-            self.ax.lines.remove(line)
+            line.remove()
         
         self.fit_line = self.ax.plot(self.x,self.yfit,color='red')
         
@@ -203,7 +425,7 @@ class LogicWidgets(QObject):
     
     def plot_vline(self,x0):
         if self.axv_line is not None:
-            self.ax.lines.remove(self.axv_line)
+            self.axv_line.remove()
             
         self.axv_line = self.ax.axvline(x=x0,ls='--',color='grey')
         
@@ -236,6 +458,56 @@ class LogicWidgets(QObject):
         time.sleep(0.01)
         QApplication.processEvents()
         
+    def fit_all_scans(self):
+        
+        if self._spec_file is None:
+            self.status.showMessage('No file was loaded')
+            return
+        
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fname, _ = QFileDialog.getSaveFileName(self.pressure,'Save fit results','',
+                                               'Text Files (*.txt);;All Files (*)',options=options)
+        if fname == '':
+            return
+        alpha_guess = self.read_alpha()
+        if alpha_guess is None:
+            return
+        
+        scan_numbers = [self.scan.scans_box.itemText(i).split()[0] for i in range(self.scan.scans_box.count())]
+        self.status.showMessage('Fitting {:d} scans...'.format(len(scan_numbers)))
+        args = (self._spec_file.fname,scan_numbers,self.scan.x_box.currentText(),self.scan.y_box.currentText())
+        options = dict(bragg_peak=self.pressure.hkl_box.currentText(),calibrant=self.calibrant,
+                       temperature_source=self.scan.temp_box.currentText(),fit_alpha=self.fit_alpha,
+                       alpha_guess=alpha_guess,tth_off=float(self.pressure.tth_offset_value.toPlainText()))
+        # The index is copied in the task thread, which is the only one that updates it.
+        self.tasks.submit('fit_state',get_spec_state,self._spec_file,
+                          on_finished=lambda state: self.fit_all_start(fname,args,state,options),
+                          on_error=lambda error: self.status.showMessage('Could not fit the scans!!!'))
+        
+    def fit_all_start(self,fname,args,state,options):
+        self.fit_tasks.submit('fit_all',fit_spec_file,*args,state=state,
+                              on_finished=lambda table: self.fit_all_done(fname,table),
+                              on_error=lambda error: self.status.showMessage('Could not fit the scans!!!'),
+                              report_progress=True,**options)
+        
+    def fit_all_done(self,fname,table):
+        try:
+            save_fit_table(fname,table)
+        except (IOError,OSError):
+            self.status.showMessage('Could not save {}!!'.format(fname))
+            return
+        self.status.showMessage('Fitted {:d} of {:d} scans, saved in {}'.format(
+            int(table['fitted'].sum()),len(table),fname.split('/')[-1]))
+        
+    def close(self):
+        # Waits for the running task, since it may be reading the spec file.
+        self.watcher.stop()
+        self.fit_tasks.cancel('fit_all')
+        self.tasks.pool.waitForDone()
+        if self._spec_file is not None:
+            self._spec_file.close()
+        
     def reset_parameters(self):
         self.popt=None
         self.update_params()
@@ -0,0 +1,172 @@
+'''
+ Copyright (c) 2018, UChicago Argonne, LLC
+ See LICENSE file.
+'''
+
+from PyQt5.QtCore import QObject,QRunnable,QThreadPool,pyqtSignal
+
+
+class Cancelled(Exception):
+    """Raised inside a task when its request was cancelled or superseded."""
+
+
+class WorkerSignals(QObject):
+
+    finished = pyqtSignal(object)
+    error = pyqtSignal(object)
+    progress = pyqtSignal(float)
+
+
+class Worker(QRunnable):
+    """Runs a function in a QThreadPool thread and reports back through signals.
+
+    Parameters
+    -----------
+    function: function
+        Function to be run. If report_progress is True, it is called with a
+    progress=callback keyword, and the callback raises Cancelled once the worker
+    was cancelled.
+
+    args, kwargs:
+        Arguments of the function.
+    """
+
+    def __init__(self,function,args=(),kwargs=None,report_progress=False):
+
+        super(Worker,self).__init__()
+        # The python object is kept by TaskQueue, Qt must not delete it.
+        self.setAutoDelete(False)
+
+        self.function = function
+        self.args = args
+        self.kwargs = dict(kwargs or {})
+        if report_progress:
+            self.kwargs['progress'] = self.report_progress
+        self.cancelled = False
+        self.signals = WorkerSignals()
+
+    def report_progress(self,fraction):
+        if self.cancelled:
+            raise Cancelled()
+        self.signals.progress.emit(fraction)
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            result = self.function(*self.args,**self.kwargs)
+        except Cancelled:
+            return
+        except Exception as error:
+            if not self.cancelled:
+                self.signals.error.emit(error)
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(result)
+
+
+class TaskQueue(QObject):
+    """Runs named tasks in the background, one at a time.
+
+    Submitting a task cancels the pending or running task with the same name, and
+    the callbacks of a cancelled task are never called. The tasks run in order in
+    a single thread, so they never access the same spec file at the same time.
+
+    Signals
+    -----------
+    busy: bool
+        Emitted when the first task starts (True) and when the last one ends (False).
+    Background tasks are not counted.
+
+    progress: float
+        Fraction done of the task that reports progress.
+    """
+
+    busy = pyqtSignal(bool)
+    progress = pyqtSignal(float)
+
+    def __init__(self):
+
+        super(TaskQueue,self).__init__()
+
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self._workers = {}
+        self._busy = False
+
+    def submit(self,name,function,*args,on_finished=None,on_error=None,report_progress=False,
+               background=False,**kwargs):
+        """Runs function(*args, **kwargs) in the background.
+
+        Parameters
+        -----------
+        name: string
+            Name of the request. A previous request with the same name is cancelled.
+
+        function: function
+            Function to be run.
+
+        on_finished: function (Optional)
+            Called in the GUI thread with the result of the function.
+
+        on_error: function (Optional)
+            Called in the GUI thread with the exception raised by the function.
+
+        report_progress: boolean (Optional)
+            If True, the function is called with a progress callback (see Worker).
+
+        background: boolean (Optional)
+            If True, the task does not change the busy state nor emits progress.
+        """
+
+        # The busy state is updated once the new task is added, so that superseding
+        # a task does not signal that the queue is idle.
+        self._remove(name)
+
+        worker = Worker(function,args,kwargs,report_progress=report_progress)
+        worker.background = background
+        worker.signals.finished.connect(lambda result: self._done(name,worker,on_finished,result))
+        worker.signals.error.connect(lambda error: self._done(name,worker,on_error,error))
+        if not background:
+            worker.signals.progress.connect(self.progress.emit)
+
+        self._workers[name] = worker
+        self._update_busy()
+        self.pool.start(worker)
+
+    def is_busy(self):
+        """Returns True if there are tasks that are not in the background."""
+        return self._busy
+
+    def cancel(self,name):
+        """Cancels the request with the given name, if there is one."""
+
+        if self._remove(name):
+            self._update_busy()
+
+    def _remove(self,name):
+        worker = self._workers.pop(name,None)
+        if worker is None:
+            return False
+        worker.cancelled = True
+        self.pool.tryTake(worker)
+        return True
+
+    def _update_busy(self):
+        busy = any(not worker.background for worker in self._workers.values())
+        if busy != self._busy:
+            self._busy = busy
+            self.busy.emit(busy)
+
+    def _done(self,name,worker,callback,value):
+        # Results of superseded requests are dropped.
+        if self._workers.get(name) is not worker:
+            return
+        del self._workers[name]
+        # The busy state is updated after the callback, so that it stays busy if the
+        # callback submits the next task.
+        try:
+            if callback is not None:
+                callback(value)
+        finally:
+            self._update_busy()